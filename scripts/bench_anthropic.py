@@ -0,0 +1,152 @@
+"""
+Benchmark of the anthropic code path against a local stub of the Messages API.
+
+    python bench_anthropic.py [--requests 200] [--concurrency 10] [--personas 5]
+
+The stub answers after a delay proportional to the input tokens it had to
+process, and skips system prompts marked for caching that it has seen in the
+last 5 minutes, roughly like the real API. Every persona is a long system
+prompt, so the report shows cold (first call) and warm latency separately.
+Pass --base-url to run the same load against another server.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import anthropic
+from aiohttp import web
+
+from chat_completions import TextResponse
+
+
+CACHE_TTL = 300
+
+
+def approx_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def make_stub(base_ms: float, per_token_ms: float) -> web.Application:
+    cache: dict[str, float] = {}
+
+    async def messages(request: web.Request) -> web.Response:
+        body = await request.json()
+        cached = uncached = written = 0
+        for block in body.get('system') or []:
+            tokens = approx_tokens(block['text'])
+            if 'cache_control' not in block:
+                uncached += tokens
+            elif cache.get(block['text'], 0) > time.monotonic():
+                cached += tokens
+            else:
+                written += tokens
+            if 'cache_control' in block:
+                cache[block['text']] = time.monotonic() + CACHE_TTL
+        for turn in body['messages']:
+            uncached += approx_tokens(turn['content'])
+
+        await asyncio.sleep((base_ms + (uncached + written) * per_token_ms) / 1000)
+        return web.json_response(
+            {
+                'id': 'msg_stub',
+                'type': 'message',
+                'role': 'assistant',
+                'model': body['model'],
+                'content': [{'type': 'text', 'text': 'stub reply'}],
+                'stop_reason': 'end_turn',
+                'stop_sequence': None,
+                'usage': {
+                    'input_tokens': uncached,
+                    'output_tokens': 3,
+                    'cache_read_input_tokens': cached,
+                    'cache_creation_input_tokens': written,
+                },
+            }
+        )
+
+    app = web.Application()
+    app.router.add_post('/v1/messages', messages)
+    return app
+
+
+def persona(number: int) -> str:
+    line = f'You are persona number {number}, a posh bot with a long backstory. '
+    return line * 200  # a few thousand tokens, like the longest chat prompts
+
+
+async def run(args):
+    runner = None
+    base_url = args.base_url
+    if base_url is None:
+        runner = web.AppRunner(make_stub(args.base_ms, args.per_token_ms))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', args.port)
+        await site.start()
+        base_url = f'http://127.0.0.1:{args.port}'
+
+    client = anthropic.AsyncAnthropic(
+        api_key=os.getenv('ANTHROPIC_API_KEY', 'stub'), base_url=base_url
+    )
+    semaphore = asyncio.Semaphore(args.concurrency)
+    seen = set()
+    cold, warm = [], []
+    failed = 0
+
+    async def one(number):
+        nonlocal failed
+        prompt = persona(number % args.personas)
+        messages = [('system', prompt), ('user', f'привет, это сообщение {number}')]
+        async with semaphore:
+            is_cold = prompt not in seen
+            seen.add(prompt)
+            started = time.monotonic()
+            reply = await TextResponse._generate_anthropic(
+                client, args.model, messages
+            )
+            elapsed = time.monotonic() - started
+        if not reply.success:
+            failed += 1
+        (cold if is_cold else warm).append(elapsed)
+
+    started = time.monotonic()
+    await asyncio.gather(*(one(number) for number in range(args.requests)))
+    elapsed = time.monotonic() - started
+
+    await client.close()
+    if runner is not None:
+        await runner.cleanup()
+
+    print(
+        f'{args.requests} requests in {elapsed:.2f}s, '
+        f'{args.requests / elapsed:.1f} req/s, {failed} failed'
+    )
+    for name, latencies in (('cold', cold), ('warm', warm)):
+        if latencies:
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            print(
+                f'{name}: {len(latencies)} calls, '
+                f'p50 {statistics.median(latencies) * 1000:.0f}ms '
+                f'p95 {p95 * 1000:.0f}ms'
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--personas', type=int, default=5)
+    parser.add_argument('--model', default='claude-3-haiku-20240307')
+    parser.add_argument('--base-url', help='benchmark this server instead of the stub')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--base-ms', type=float, default=50, help='stub base latency')
+    parser.add_argument(
+        '--per-token-ms', type=float, default=0.1, help='stub cost of an input token'
+    )
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+One-off cleanup of history saved before messages were deduplicated on ingest.
+
+Keeps the first copy of every message: by telegram message_id when it is
+stored, by (timestamp, author, text) for older records. Rebuilds the seen
+ids set and search/timeline indexes afterwards, since sequence numbers change.
+"""
+import hashlib
+import os
+import sys
+import time
+
+import redis
+
+import reindex_history
+from config import Config
+from message_store import MessageStore, StoredChatMessage
+
+
+PAGE_SIZE = 1000
+
+
+def identity(message: StoredChatMessage) -> bytes:
+    if message.message_id is not None:
+        return f'id:{message.message_id}'.encode()
+    raw = f'{message.timestamp}\0{message.from_username}\0{message.text}'
+    return hashlib.sha1(raw.encode()).digest()
+
+
+def main(config: Config, store: MessageStore, chat_id: int):
+    conn = store.redis_conn
+    tag = config.history_key(chat_id)
+    tmp = f'{tag}:dedup'
+    conn.delete(tmp)
+
+    started = time.monotonic()
+    total = conn.llen(tag)
+    seen = set()
+    message_ids = {}
+    kept = 0
+    # oldest first, LPUSH into tmp keeps the original order
+    for seq_from in range(0, total, PAGE_SIZE):
+        seq_to = min(seq_from + PAGE_SIZE, total) - 1
+        page = conn.lrange(tag, -(seq_to + 1), -(seq_from + 1))
+        unique = []
+        for raw in reversed(page):
+            message = StoredChatMessage.deserialize(raw)
+            key = identity(message)
+            if key in seen:
+                continue
+            seen.add(key)
+            unique.append(raw)
+            if message.message_id is not None:
+                message_ids[message.message_id] = message.message_id
+        if unique:
+            conn.lpush(tmp, *unique)
+            kept += len(unique)
+        print(f'Checked {seq_to + 1}/{total}', end='\r')
+    print(f'\nKeeping {kept} of {total} messages')
+
+    if kept == total:
+        conn.delete(tmp)
+        print('Nothing to do')
+        return
+
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(tag)
+            if pipe.llen(tag) != total:
+                raise redis.WatchError
+            pipe.multi()
+            pipe.rename(tmp, tag)
+            seen_key = store.seen_key(tag)
+            pipe.delete(seen_key)
+            if message_ids:
+                pipe.zadd(seen_key, message_ids)
+                pipe.zremrangebyrank(seen_key, 0, -store.SEEN_IDS_KEPT - 1)
+            pipe.execute()
+        except redis.WatchError:
+            conn.delete(tmp)
+            print(f'{tag} changed while deduplicating, stop the bot and rerun')
+            sys.exit(1)
+    print(f'Removed {total - kept} duplicates in {time.monotonic() - started:.1f}s')
+
+    reindex_history.main(config, store, chat_id)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Need chat_id as a parameter')
+        sys.exit(1)
+    chat_id = int(sys.argv[1])
+    config = Config.read_toml(path=os.getenv('BOT_CONFIG_TOML'))
+    store = MessageStore.from_env()
+    main(config, store, chat_id)
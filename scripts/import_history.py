@@ -0,0 +1,269 @@
+"""
+Load history dumps back into redis, or replay stored history through the bot.
+
+    python import_history.py load dump.ndjson <chat_id> [--me other_bot] [--reencode]
+    python import_history.py replay <chat_id> --to-chat-id N [--rate 5]
+
+`load` reads a file written by dump_data_from_storage.py (one message per line,
+newest first) and pushes it in batches of BATCH_SIZE. Lines are RPUSHed in file
+order, so the list ends up exactly as it was dumped. Set REDIS_URL to load
+into another redis, and --me to load under another bot's keys.
+
+`replay` feeds stored messages, oldest first, to the bot handlers as if they
+just arrived in another chat, with real LLM and Telegram calls. Nothing is
+saved or counted while replaying and no stream workers or digests are started,
+replies are sent without the messages they answer and reactions are skipped.
+Use a test bot token and a test chat for load testing.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import zlib
+
+import reindex_history
+from config import Config
+from memory import RetrievalMemory
+from message_store import MessageStore, StoredChatMessage
+
+
+BATCH_SIZE = 1000
+
+
+def load(
+    store: MessageStore,
+    tag: str,
+    path: str,
+    reencode: bool = False,
+    replace: bool = False,
+    batch_size: int = BATCH_SIZE,
+    memory: RetrievalMemory | None = None,
+):
+    conn = store.redis_conn
+    if conn.exists(tag) and not replace:
+        print(f'{tag} is not empty, pass --replace to overwrite it')
+        sys.exit(1)
+
+    tmp = f'{tag}:import'
+    conn.delete(tmp)
+    started = time.monotonic()
+    total = 0
+    size = 0
+    message_ids = {}
+    batch = []
+
+    def flush():
+        conn.rpush(tmp, *batch)
+        batch.clear()
+        elapsed = time.monotonic() - started
+        print(
+            f'Loaded {total} messages, {total / elapsed:.0f} msg/s, '
+            f'{size / elapsed / 2**20:.1f} MiB/s',
+            end='\r',
+        )
+
+    with open(path, 'rb') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            if reencode or len(message_ids) < store.SEEN_IDS_KEPT:
+                message = StoredChatMessage.deserialize(line)
+                if reencode:
+                    line = message.serialize().encode()
+                # the dump is newest first, so these are the latest ids
+                if message.message_id is not None:
+                    message_ids[message.message_id] = message.message_id
+            batch.append(line)
+            total += 1
+            size += len(line)
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+
+    if total == 0:
+        print(f'{path} has no messages')
+        return
+
+    seen_key = store.seen_key(tag)
+    with conn.pipeline() as pipe:
+        pipe.rename(tmp, tag)
+        pipe.delete(seen_key)
+        if message_ids:
+            pipe.zadd(seen_key, message_ids)
+            pipe.zremrangebyrank(seen_key, 0, -store.SEEN_IDS_KEPT - 1)
+        pipe.execute()
+    elapsed = time.monotonic() - started
+    print(
+        f'\nLoaded {total} messages ({size / 2**20:.1f} MiB) into {tag} '
+        f'in {elapsed:.1f}s, {total / elapsed:.0f} msg/s'
+    )
+
+    reindex_history.reindex(store, tag, memory)
+
+
+def fake_update(update_id: int, chat_id: int, message: StoredChatMessage):
+    from aiogram import types
+
+    # date is now, otherwise admission drops the update as stale
+    return types.Update(
+        update_id=update_id,
+        message=types.Message(
+            message_id=message.message_id or update_id,
+            date=int(time.time()),
+            chat=types.Chat(id=chat_id, type='supergroup', title=message.chat_name),
+            from_user=types.User(
+                id=zlib.crc32((message.from_username or '').encode()) + 1,
+                is_bot=False,
+                first_name=message.from_full_name or message.from_username or '?',
+                username=message.from_username,
+            ),
+            text=message.text,
+        ),
+    )
+
+
+async def replay(
+    store: MessageStore,
+    tag: str,
+    chat_id: int,
+    limit: int = -1,
+    rate: float = 1.0,
+    speed: float | None = None,
+):
+    """
+    Feed messages through the dispatcher, `rate` per second, or keeping the
+    original gaps between messages sped up `speed` times
+    """
+    import bot_handler
+
+    seq_range = store.seq_range_last(tag, limit)
+    if seq_range is None:
+        print(f'{tag} is empty')
+        return
+
+    host = bot_handler.BotHost.from_env(replay=True)
+    me = Config.bot_of_history_key(tag)
+    bot = host.app_for(me).bot
+    background_tasks = host.start_background_tasks()
+    dp = host.build_dispatcher()
+    latencies = []
+    errors = 0
+
+    async def feed(update):
+        nonlocal errors
+        started = time.monotonic()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            errors += 1
+            print(f'\nUpdate {update.update_id} failed: {e!r}')
+        latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    tasks = set()
+    previous_ts = None
+    fed = 0
+    try:
+        async for message in store.iter_seq_range(tag, *seq_range):
+            if message.from_username == me or not message.text:
+                continue
+            if speed:
+                if previous_ts is not None:
+                    await asyncio.sleep(max(0, message.timestamp - previous_ts) / speed)
+                previous_ts = message.timestamp
+            elif fed:
+                await asyncio.sleep(1 / rate)
+            fed += 1
+            task = asyncio.create_task(feed(fake_update(fed, chat_id, message)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            print(f'Fed {fed}, in flight {len(tasks)}', end='\r')
+        await asyncio.gather(*tasks)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await host.close()
+
+    if not latencies:
+        print('Nothing to replay')
+        return
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f'\nReplayed {fed} messages in {elapsed:.1f}s ({fed / elapsed:.1f} msg/s), '
+        f'{errors} failed, handler latency p50 '
+        f'{statistics.median(latencies):.2f}s p95 {p95:.2f}s'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load_args = commands.add_parser('load', help='load a dump into redis')
+    load_args.add_argument('path')
+    load_args.add_argument('chat_id', type=int)
+    load_args.add_argument('--me', help='bot name to store history under')
+    load_args.add_argument(
+        '--reencode',
+        action='store_true',
+        help='rewrite every message in the current storage format',
+    )
+    load_args.add_argument(
+        '--replace', action='store_true', help='overwrite existing history'
+    )
+    load_args.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    replay_args = commands.add_parser('replay', help='replay history to the bot')
+    replay_args.add_argument('chat_id', type=int)
+    replay_args.add_argument(
+        '--to-chat-id',
+        type=int,
+        required=True,
+        help='test chat to replay into, must differ from chat_id',
+    )
+    replay_args.add_argument('--limit', type=int, default=-1)
+    pace = replay_args.add_mutually_exclusive_group()
+    pace.add_argument('--rate', type=float, default=1.0, help='messages per second')
+    pace.add_argument('--speed', type=float, help='original pace sped up N times')
+
+    args = parser.parse_args()
+    if args.command == 'replay' and args.to_chat_id == args.chat_id:
+        parser.error('replaying into the chat the history came from is not allowed')
+    config = Config.read_toml(path=os.getenv('BOT_CONFIG_TOML'))
+    store = MessageStore.from_env()
+
+    if args.command == 'load':
+        me = args.me or config.me_strip_lower
+        tag = f'matvey-3000:history:{me}:{args.chat_id}'
+        memory = RetrievalMemory.from_config(config.memory) if config.memory else None
+        load(
+            store,
+            tag,
+            args.path,
+            args.reencode,
+            args.replace,
+            args.batch_size,
+            memory,
+        )
+    else:
+        tag = config.history_key(args.chat_id)
+        asyncio.run(
+            replay(
+                store,
+                tag,
+                chat_id=args.to_chat_id,
+                limit=args.limit,
+                rate=args.rate,
+                speed=args.speed,
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
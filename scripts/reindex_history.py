@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+
+from config import Config
+from memory import RetrievalMemory
+from message_store import MessageStore, StoredChatMessage
+from search_index import SearchIndex
+
+
+PAGE_SIZE = 1000
+
+
+def reindex(store: MessageStore, tag: str, memory: RetrievalMemory | None = None):
+    index = SearchIndex(store.redis_conn)
+
+    started = time.monotonic()
+    timeline = store.timeline_key(tag)
+    dropped = index.drop(tag) + store.redis_conn.unlink(timeline)
+    print(f'Dropped {dropped} index keys for {tag}')
+    if memory is not None:
+        memory.drop(tag)
+
+    total = store.redis_conn.llen(tag)
+    # walk from the oldest message (right end of the list) to the newest
+    for seq_from in range(0, total, PAGE_SIZE):
+        seq_to = min(seq_from + PAGE_SIZE, total) - 1
+        page = store.redis_conn.lrange(tag, -(seq_to + 1), -(seq_from + 1))
+        items = []
+        timestamps = {}
+        for seq, raw in zip(range(seq_to, seq_from - 1, -1), page):
+            message = StoredChatMessage.deserialize(raw)
+            items.append((tag, seq, message.text))
+            timestamps[seq] = message.timestamp
+        index.index_many(items)
+        if memory is not None:
+            # oldest first, the same order ingest appends in
+            memory.index_many(items[::-1])
+        store.redis_conn.zadd(timeline, timestamps)
+        print(f'Indexed {seq_to + 1}/{total}', end='\r')
+
+    print(f'\nReindexed {total} messages of {tag} in {time.monotonic() - started:.1f}s')
+
+
+def main(config: Config, store: MessageStore, chat_id: int):
+    memory = RetrievalMemory.from_config(config.memory) if config.memory else None
+    reindex(store, config.history_key(chat_id), memory)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Need chat_id as a parameter')
+        sys.exit(1)
+    chat_id = int(sys.argv[1])
+    config = Config.read_toml(path=os.getenv('BOT_CONFIG_TOML'))
+    store = MessageStore.from_env()
+    main(config, store, chat_id)
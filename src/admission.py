@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import time
+from dataclasses import dataclass, replace
+
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Lane:
+    """
+    Limits for one class of handlers.
+
+    concurrency: how many handlers of this class may run at once
+    queue_size: how many more may wait for a free slot
+    max_wait: how long one may wait for a slot, seconds
+    max_age: updates older than that are dropped without a reply, seconds
+    """
+
+    concurrency: int
+    queue_size: int
+    max_wait: float
+    max_age: float
+
+
+DEFAULT_LANES = {
+    'chat': Lane(concurrency=32, queue_size=64, max_wait=10, max_age=60),
+    'translation': Lane(concurrency=8, queue_size=16, max_wait=20, max_age=120),
+    'image': Lane(concurrency=4, queue_size=8, max_wait=30, max_age=300),
+    'summary': Lane(concurrency=2, queue_size=4, max_wait=60, max_age=600),
+}
+
+
+class _LaneState:
+    def __init__(self, lane: Lane):
+        self.lane = lane
+        self.semaphore = asyncio.Semaphore(lane.concurrency)
+        self.waiting = 0
+
+
+class AdmissionController:
+    """
+    Bounded concurrency per handler class. Every class has its own slots and
+    wait queue, so bulk jobs like /sum never hold up interactive replies.
+    """
+
+    def __init__(self, lanes: dict[str, Lane] | None = None):
+        self.lanes = {**DEFAULT_LANES, **(lanes or {})}
+        self._state = {name: _LaneState(lane) for name, lane in self.lanes.items()}
+
+    @classmethod
+    def from_config(cls, limits: dict[str, dict]) -> AdmissionController:
+        lanes = {}
+        for name, values in limits.items():
+            base = DEFAULT_LANES.get(name, DEFAULT_LANES['chat'])
+            lanes[name] = replace(base, **values)
+        return cls(lanes)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, name: str):
+        state = self._state[name]
+        if not state.semaphore.locked():
+            # free slot, acquire() returns without yielding to the loop
+            await state.semaphore.acquire()
+        elif state.waiting >= state.lane.queue_size:
+            metrics.inc(f'admission.{name}.queue_full')
+            raise Overloaded(f'{name}: queue is full')
+        else:
+            state.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    state.semaphore.acquire(), state.lane.max_wait
+                )
+            except TimeoutError:
+                metrics.inc(f'admission.{name}.timed_out')
+                raise Overloaded(f'{name}: no free slot in {state.lane.max_wait}s')
+            finally:
+                state.waiting -= 1
+
+        metrics.inc(f'admission.{name}.admitted')
+        try:
+            yield
+        finally:
+            state.semaphore.release()
+
+    def stale(self, name: str, sent_at: float) -> bool:
+        return time.time() - sent_at > self.lanes[name].max_age
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """
+    Inner middleware: admits handlers flagged with flags={'admission': '<lane>'}
+    and answers with a polite busy message when their lane is overloaded.
+    """
+
+    BUSY_REPLY = '🥵 я сейчас очень занят, попробуй чуть позже'
+
+    def __init__(self, controller: AdmissionController):
+        self.controller = controller
+
+    async def __call__(self, handler, event: types.Message, data):
+        name = get_flag(data, 'admission')
+        if name is None:
+            return await handler(event, data)
+
+        if self.controller.stale(name, event.date.timestamp()):
+            metrics.inc(f'admission.{name}.stale')
+            return None
+
+        try:
+            async with self.controller.admit(name):
+                return await handler(event, data)
+        except Overloaded as e:
+            logger.warning('Shedding update %s: %s', event.message_id, e)
+            await event.reply(self.BUSY_REPLY)
+            return None
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import collections
+import time
+
+import redis
+
+from config import Config
+from message_store import StoredChatMessage
+
+
+WEEKDAYS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+HEAT_LEVELS = ' ░▒▓█'
+
+
+def render_heatmap(cells: dict[str, int]) -> str:
+    """cells is {'<weekday>:<hour>': count}, result is a 7x24 text grid"""
+    peak = max(cells.values(), default=0)
+    header = list(' ' * 24)
+    for hour in (0, 6, 12, 18):
+        header[hour : hour + len(str(hour))] = str(hour)
+    lines = ['   ' + ''.join(header)]
+    for weekday, name in enumerate(WEEKDAYS):
+        row = []
+        for hour in range(24):
+            count = cells.get(f'{weekday}:{hour}', 0)
+            level = 0 if not count else 1 + (count * (len(HEAT_LEVELS) - 2)) // peak
+            row.append(HEAT_LEVELS[level])
+        lines.append(f'{name} {"".join(row)}')
+    return '\n'.join(lines)
+
+
+class ChatAnalytics:
+    """
+    Counters updated as messages are ingested, so /stats reads a handful of
+    small keys no matter how long the history is.
+
+    per history key:
+      day:<YYYYMMDD>  hash   author -> messages that day (kept for `keep_days`)
+      dau:<YYYYMMDD>  hll    distinct authors that day
+      heatmap         hash   <weekday>:<hour> -> messages
+      llm             hash   replies, <provider>:calls|latency_ms|tokens
+
+    History keys name the bot, so one instance serves every hosted bot.
+    """
+
+    def __init__(self, redis_conn: redis.Redis, keep_days: int = 90):
+        self.redis_conn = redis_conn
+        self.keep_days = keep_days
+
+    @staticmethod
+    def key(tag: str, name: str) -> str:
+        return f'{tag.replace(":history:", ":stats:", 1)}:{name}'
+
+    @staticmethod
+    def day(timestamp: float) -> str:
+        return time.strftime('%Y%m%d', time.localtime(timestamp))
+
+    def record_messages(self, items: list[tuple[str, StoredChatMessage]]):
+        ttl = self.keep_days * 86400
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for tag, message in items:
+                if message.from_username == Config.bot_of_history_key(tag):
+                    # our own replies are counted in record_llm_call
+                    continue
+                author = message.from_full_name or message.from_username or '?'
+                day = self.day(message.timestamp)
+                local = time.localtime(message.timestamp)
+                hour_of_week = f'{local.tm_wday}:{local.tm_hour}'
+                day_key = self.key(tag, f'day:{day}')
+                dau_key = self.key(tag, f'dau:{day}')
+                pipe.hincrby(day_key, author, 1)
+                pipe.expire(day_key, ttl)
+                pipe.pfadd(dau_key, author)
+                pipe.expire(dau_key, ttl)
+                pipe.hincrby(self.key(tag, 'heatmap'), hour_of_week, 1)
+            pipe.execute()
+
+    def record_llm_call(self, tag: str, reply, is_reply: bool = True):
+        key = self.key(tag, 'llm')
+        provider = reply.provider or 'unknown'
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            if is_reply:
+                pipe.hincrby(key, 'replies', 1)
+            pipe.hincrby(key, f'{provider}:calls', 1)
+            pipe.hincrby(key, f'{provider}:latency_ms', reply.latency_ms)
+            pipe.hincrby(key, f'{provider}:tokens', reply.tokens)
+            pipe.execute()
+
+    def fetch(self, tag: str, days: int = 7, now: float | None = None) -> dict:
+        now = time.time() if now is None else now
+        day_names = [self.day(now - i * 86400) for i in range(days)]
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for day in day_names:
+                pipe.hgetall(self.key(tag, f'day:{day}'))
+            pipe.pfcount(*[self.key(tag, f'dau:{day}') for day in day_names])
+            pipe.hgetall(self.key(tag, 'heatmap'))
+            pipe.hgetall(self.key(tag, 'llm'))
+            *per_day, unique_authors, heatmap, llm = pipe.execute()
+
+        talkers = collections.Counter()
+        for counts in per_day:
+            for author, count in counts.items():
+                talkers[author.decode()] += int(count)
+
+        providers = collections.defaultdict(dict)
+        replies = 0
+        for field, value in llm.items():
+            field = field.decode()
+            if field == 'replies':
+                replies = int(value)
+                continue
+            provider, _, metric = field.rpartition(':')
+            providers[provider][metric] = int(value)
+
+        return {
+            'days': days,
+            'talkers': talkers,
+            'unique_authors': unique_authors,
+            'heatmap': {k.decode(): int(v) for k, v in heatmap.items()},
+            'replies': replies,
+            'providers': dict(providers),
+        }
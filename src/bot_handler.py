@@ -1,37 +1,103 @@
 from __future__ import annotations
 
 import asyncio
-import base64
+import binascii
 import collections
+import datetime
+import functools
 import logging
 import os
 import random
+import re
+import signal
 import time
+from dataclasses import dataclass
 
 import openai
-import tiktoken
 
 from aiogram import F
-from aiogram import Bot, Dispatcher, Router, html, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, html, types
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.filters import Command
-
-from config import Config
-from chat_completions import TextResponse, ImageResponse
+from aiogram.methods import SetMessageReaction
+
+import metrics
+from admission import AdmissionController, AdmissionMiddleware
+from analytics import ChatAnalytics, render_heatmap
+from config import Config, ConfigError, ConfigWatcher
+from digests import DigestScheduler
+from chat_completions import TextResponse, ImageResponse, model_router
+from image_cache import ImageCache
+from ingest import (
+    ActivityRecorder,
+    HistoryWriter,
+    Ingest,
+    MemoryIndexer,
+    SearchIndexer,
+)
+from memory import RetrievalMemory
 from message_store import MessageStore, StoredChatMessage
+from model_router import TASK_TRANSLATION
+from overrides import RuntimeOverrides
+from prefilter import PreFilterMiddleware
+from search_index import SearchIndex
+from singleflight import SingleFlight
+from streams import StreamWorker
+import summary
+from tg_scheduler import TelegramScheduler, awaited_edits
 
 
-API_TOKEN = os.getenv('TELEGRAM_API_TOKEN')
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 bot_props = DefaultBotProperties(parse_mode='HTML')
-bot = Bot(token=API_TOKEN, default=bot_props)
-router = Router()
-message_store = MessageStore.from_env()
 
-config = Config.read_toml(path=os.getenv('BOT_CONFIG_TOML'))
+# shared by all bots hosted in this process
+message_store = MessageStore.from_env()
+search_index = SearchIndex(message_store.redis_conn)
+analytics = ChatAnalytics(message_store.redis_conn)
+singleflight = SingleFlight(message_store.redis_conn, namespace='bots')
+
+
+@dataclass
+class BotApp:
+    """
+    One hosted bot. Handlers get it as `app` from BotSelectorMiddleware,
+    everything that is not per bot lives in module globals.
+    """
+
+    config: Config
+    config_path: str
+    bot: Bot
+    ingest: Ingest
+    prefilter: PreFilterMiddleware
+    image_cache: ImageCache
+    memory: RetrievalMemory | None = None
+    digests: DigestScheduler | None = None
+    # replayed history, see BotHost
+    replay: bool = False
+
+    async def filter_own_updates(self, message: types.Message, app: BotApp) -> bool:
+        return app is self
+
+
+async def generate_summary_part(
+    config, chat_id, messages, task, record=True
+) -> TextResponse:
+    llm_reply = await TextResponse.generate(
+        config=config,
+        chat_id=chat_id,
+        messages=messages,
+        task=task,
+    )
+    if record:
+        analytics.record_llm_call(
+            config.history_key(chat_id), llm_reply, is_reply=False
+        )
+    return llm_reply
 
 
 def extract_message_chain(last_message_in_thread: types.Message, bot_id: int):
@@ -57,7 +123,7 @@ def extract_message_chain(last_message_in_thread: types.Message, bot_id: int):
     return [(role, text) for role, text in payload]
 
 
-async def react(success, message):
+async def react(config, success, message):
     yes = config.positive_emojis
     nope = config.negative_emojis
     react = random.choice(yes) if success else random.choice(nope)
@@ -65,32 +131,56 @@ async def react(success, message):
     await message.react(reaction=[react])
 
 
-@router.message(Command(commands=['blerb'], ignore_mention=True))
 async def dump_message_info(message: types.Message):
     logger.info(f'incoming blerb from {message.chat.id}')
     await message.reply(f'chat id: {html.code(message.chat.id)}')
 
 
-@router.message(Command(commands=['mode_claude'], ignore_mention=True))
-async def switch_to_claude(message: types.Message):
-    config.override_provider_for_chat_id(message.chat.id, config.PROVIDER_ANTHROPIC)
-    await message.reply(f'🤖теперь я на мозгах {config.PROVIDER_ANTHROPIC}!')
+async def switch_chat_provider(message: types.Message, config: Config, provider):
+    if config.override_provider_for_chat_id(message.chat.id, provider):
+        await message.reply(f'🤖теперь я на мозгах {provider}!')
+    else:
+        await message.reply('nope 🙅')
+
+
+async def switch_to_claude(message: types.Message, app: BotApp):
+    config = app.config
+    await switch_chat_provider(message, config, config.PROVIDER_ANTHROPIC)
+
+
+async def switch_to_chatgpt(message: types.Message, app: BotApp):
+    config = app.config
+    await switch_chat_provider(message, config, config.PROVIDER_OPENAI)
 
 
-@router.message(Command(commands=['mode_chatgpt'], ignore_mention=True))
-async def switch_to_chatgpt(message: types.Message):
-    config.override_provider_for_chat_id(message.chat.id, config.PROVIDER_OPENAI)
-    await message.reply(f'🤖теперь я на мозгах {config.PROVIDER_OPENAI}!')
+async def switch_to_yandexgpt(message: types.Message, app: BotApp):
+    config = app.config
+    await switch_chat_provider(message, config, config.PROVIDER_YANDEXGPT)
 
 
-@router.message(Command(commands=['mode_yandex'], ignore_mention=True))
-async def switch_to_yandexgpt(message: types.Message):
-    config.override_provider_for_chat_id(message.chat.id, config.PROVIDER_YANDEXGPT)
-    await message.reply(f'🤖теперь я на мозгах {config.PROVIDER_YANDEXGPT}!')
+async def switch_provider(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    """/mode <provider> or /mode_<provider>, for any configured provider"""
+    config = app.config
+    if command.command == 'mode':
+        name = (command.args or '').strip()
+    else:
+        name = command.command.removeprefix('mode_')
+    if name not in config.provider_names:
+        current = config.provider_for_chat_id(message.chat.id)
+        await message.reply(
+            f'сейчас я на мозгах {current}, можно: '
+            + ', '.join(html.code(f'/mode_{name}') for name in config.provider_names)
+        )
+        return
+    await switch_chat_provider(message, config, name)
 
 
-@router.message(config.filter_chat_allowed, Command(commands=['prompt']))
-async def dump_set_prompt(message: types.Message, command: types.CommandObject):
+async def dump_set_prompt(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    config = app.config
     new_prompt = command.args
     if not new_prompt:
         await message.reply(config.rich_info(message.chat.id))
@@ -99,18 +189,32 @@ async def dump_set_prompt(message: types.Message, command: types.CommandObject):
     success = config.override_prompt_for_chat(message.chat.id, new_prompt)
     if success:
         await message.answer(
-            'okie-dokie 👌 prompt изменён но нет никаких гарантий что это надолго'
+            'okie-dokie 👌 prompt изменён и переживёт даже мой рестарт'
         )
     else:
         await message.answer('nope 🙅')
 
 
-@router.message(config.filter_chat_allowed, Command(commands=['pic']))
-async def gimme_pic(message: types.Message, command: types.CommandObject):
+async def gimme_pic(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    config, image_cache = app.config, app.image_cache
     prompt = command.args
+    caption = f'DALL-E2 prompt: {prompt}'
+    cached_file_id = image_cache.get('dall-e', prompt, ImageResponse.SIZE)
+    if cached_file_id is not None:
+        await message.answer_photo(cached_file_id, caption=caption)
+        await react(config, success=True, message=message)
+        return
+
     await message.chat.do('upload_photo')
     try:
-        response = await ImageResponse.generate(prompt, mode='dall-e')
+        response = await singleflight.do(
+            singleflight.make_key('any', 'pic', prompt, window=60),
+            lambda: ImageResponse.generate(prompt, mode='dall-e'),
+            dumps=ImageResponse.serialize,
+            loads=ImageResponse.deserialize,
+        )
     except openai.BadRequestError:
         messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
         messages_to_send.append(
@@ -125,22 +229,36 @@ async def gimme_pic(message: types.Message, command: types.CommandObject):
             chat_id=message.chat.id,
             messages=messages_to_send,
         )
-        await message.answer(llm_reply.text)
-        await react(success=False, message=message)
+        await message.answer(html.quote(llm_reply.text))
+        await react(config, success=False, message=message)
     else:
         await message.chat.do('upload_photo')
         image_from_url = types.URLInputFile(response.b64_or_url)
-        caption = f'DALL-E2 prompt: {prompt}'
-        await message.answer_photo(image_from_url, caption=caption)
-        await react(success=True, message=message)
+        sent = await message.answer_photo(image_from_url, caption=caption)
+        image_cache.put('dall-e', prompt, ImageResponse.SIZE, sent.photo[-1].file_id)
+        await react(config, success=True, message=message)
 
 
-@router.message(config.filter_chat_allowed, Command(commands=['pik']))
-async def gimme_pikk(message: types.Message, command: types.CommandObject):
+async def gimme_pikk(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    config, image_cache = app.config, app.image_cache
     prompt = command.args
+    caption = f'Kandinksi-3 prompt: {prompt}'
+    cached_file_id = image_cache.get('kandinski', prompt, ImageResponse.SIZE)
+    if cached_file_id is not None:
+        await message.answer_photo(cached_file_id, caption=caption)
+        await react(config, success=True, message=message)
+        return
+
     await message.chat.do('upload_photo')
     try:
-        response = await ImageResponse.generate(prompt, mode='kandinski')
+        response = await singleflight.do(
+            singleflight.make_key('any', 'pik', prompt, window=60),
+            lambda: ImageResponse.generate(prompt, mode='kandinski'),
+            dumps=ImageResponse.serialize,
+            loads=ImageResponse.deserialize,
+        )
     except openai.BadRequestError:
         messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
         messages_to_send.append(
@@ -155,8 +273,8 @@ async def gimme_pikk(message: types.Message, command: types.CommandObject):
             chat_id=message.chat.id,
             messages=messages_to_send,
         )
-        await message.answer(llm_reply.text)
-        await react(success=False, message=message)
+        await message.answer(html.quote(llm_reply.text))
+        await react(config, success=False, message=message)
     else:
         await message.chat.do('upload_photo')
         if response.censored:
@@ -173,218 +291,601 @@ async def gimme_pikk(message: types.Message, command: types.CommandObject):
                 chat_id=message.chat.id,
                 messages=messages_to_send,
             )
-            await message.answer(llm_reply.text)
-            await react(success=False, message=message)
+            await message.answer(html.quote(llm_reply.text))
+            await react(config, success=False, message=message)
         else:
             # await message.reply(json.dumps(response, indent=4))
-            caption = f'Kandinksi-3 prompt: {prompt}'
 
-            im_b64 = response.b64_or_url.encode()
-            im_f = base64.decodebytes(im_b64)
+            # a2b_base64 reads the ascii str buffer in place, so the only
+            # copy made here is the decoded image itself
             image = types.BufferedInputFile(
-                im_f,
+                binascii.a2b_base64(response.b64_or_url),
                 'kandinski.png',
             )
 
-            await message.answer_photo(
+            sent = await message.answer_photo(
                 photo=image,
                 caption=caption,
             )
-            await react(success=True, message=message)
+            image_cache.put(
+                'kandinski', prompt, ImageResponse.SIZE, sent.photo[-1].file_id
+            )
+            await react(config, success=True, message=message)
 
 
-@router.message(config.filter_chat_allowed, Command(commands=['ru', 'en']))
-async def translate_ruen(message: types.Message, command: types.CommandObject):
+async def translate_ruen(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    config = app.config
     prompt_tuple = config.fetch_translation_prompt_tuple(command.command)
     messages_to_send = [prompt_tuple, ('user', command.args)]
     await message.chat.do('typing')
-    llm_reply = await TextResponse.generate(
-        config=config,
-        chat_id=message.chat.id,
-        messages=messages_to_send,
+    llm_reply = await singleflight.do(
+        singleflight.make_key(
+            f'{config.me_strip_lower}:{message.chat.id}',
+            command.command,
+            command.args,
+            window=60,
+        ),
+        lambda: TextResponse.generate(
+            config=config,
+            chat_id=message.chat.id,
+            messages=messages_to_send,
+            task=TASK_TRANSLATION,
+        ),
+        dumps=TextResponse.serialize,
+        loads=TextResponse.deserialize,
     )
     func = message.reply if llm_reply.success else message.answer
-    await func(llm_reply.text)
-    await react(llm_reply.success, message)
+    await func(html.quote(llm_reply.text))
+    if config[message.chat.id].save_messages and not app.replay:
+        analytics.record_llm_call(config.history_key(message.chat.id), llm_reply)
+    await react(config, llm_reply.success, message)
 
 
-@router.message(config.filter_is_admin, Command(commands=['admin_stats']))
-async def handle_stats_command(message: types.Message, command: types.CommandObject):
+async def handle_stats_command(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    config = app.config
     stats = message_store.fetch_stats(keys_pattern='matvey-3000:history:*')
     total_chats = len(config)
     response = f'Total keys in storage: {len(stats)}'
     per_chat = '\n'.join(f'{key}: {count}' for key, count in stats)
     await message.reply(
-        '\n'.join(['[ADMIN]', response, '===', per_chat, f'Total chats: {total_chats}'])
+        '\n'.join(
+            [
+                '[ADMIN]',
+                response,
+                '===',
+                per_chat,
+                f'Total chats: {total_chats}',
+                '===',
+                metrics.render(),
+                '===',
+                model_router.render(),
+            ]
+        )
     )
 
 
-@router.message(
-    config.filter_summary_enabled,
-    Command(commands=['samari', 'sammari', 'sum', 'sosum']),
-)
-async def handle_summary_command(message: types.Message, command: types.CommandObject):
-    tag = f'matvey-3000:history:{config.me_strip_lower}:{message.chat.id}'
-    limit = command.args
-    limit = -1 if limit is None else int(command.args)
-    messages = message_store.fetch_messages(key=tag, limit=limit)
-    # encoding = tiktoken.get_encoding("cl100k_base")
-    encoding = tiktoken.encoding_for_model(config.model_for_chat_id(message.chat.id))
-    total = len(messages)
-    info_message = await message.answer(f'🤖 Обрабатываю {total} сообщений')
-    progress = await message.answer(f'Обрабатываю 0/{total} чанков')
-    # full_text = '\n'.join(m.text for m in messages)
-
-    max_chunk_size = 16385
-
-    def L(x):
-        return len(encoding.encode(x))
-
-    def chunk_it(texts):
-        chunks = []
-        current_chunk = ""
-
-        for tt in texts:
-            if L(current_chunk) + L(tt) < max_chunk_size:
-                current_chunk += tt + "\n"
-            else:
-                chunks.append(current_chunk.strip())
-                current_chunk = tt + "\n"
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        return chunks
-
-    # get summary for each chunk
-    async def get_summaries(chunks, entity='чанк'):
-        prompt = """
-You are a helpful assistant who is a pinnacle of retelling craft.
-You have to retell text in no more than 25 sentences using Russian language only.
-The text is written by other chat members. You need to retell in short their most emotionally charged and interesting
-phrases by mentioning their originators and then retelling up their points. You can seldom mix up or exaggerate things
-purely for comic purposes. You never lose a chronology of events, and try to mention each participant's important input,
-while balancing the amount of attention each participant gets. Texts produced by chatbots (such as Matthew3000,
-Ben the Snarky Shark, Summary Bot, User of the Day) have lower priority always. 
-        """
-        prompt = prompt.strip()
-        total_chunks = len(chunks)
-        summaries = []
-        for i, chunk in enumerate(chunks, start=1):
-            mm = [('system', prompt), ('user', chunk)]
-            await progress.edit_text(f'Обрабатываю {entity} {i}/{total_chunks}')
-            await message.chat.do('typing')
-            llm_reply = await TextResponse.generate(
-                config=config,
-                chat_id=message.chat.id,
-                messages=mm,
-            )
-            summaries.append(llm_reply.text)
-            await asyncio.sleep(0.5)
-        return summaries
-
-    chunks = chunk_it(texts=(m.text for m in messages))
-    summaries = await get_summaries(chunks)
-
-    final_prompt = """
-You are a modest and helpful assistant who is a pinnacle of retelling craft.
-You have to retell text in no more than 25 sentences using Russian language only.
-The text is written by other chat members. You need to retell in short their most emotionally charged and interesting
-phrases by mentioning their originators and then retelling up their points. You can seldom mix up or exaggerate things
-purely for comic purposes. You never lose a chronology of events, and try to mention each participant's important input,
-while balancing the amount of attention each participant gets. Texts produced by chatbots (such as Matthew3000,
-Ben the Snarky Shark, Summary Bot, User of the Day) have lower priority always.
-After you make a summary, highlight three most outstanding facts or points from it in a separate paragraph.
-"""
-    final_prompt = final_prompt.strip()
-    L_final_prompt = L(final_prompt)
-
-    final_summary = '\n'.join(summaries)
-    while L(final_summary) > (max_chunk_size - L_final_prompt):
-        final_summary = '\n'.join(summaries)
-        chunks = chunk_it(texts=summaries)
-        summaries = await get_summaries(chunks, entity='предсаммари')
-        final_summary = '\n'.join(summaries)
+async def handle_search_command(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    config = app.config
+    if not config[message.chat.id].save_messages:
+        await message.reply('🤷 я не сохраняю историю этого чата')
+        return
+    if not command.args:
+        await message.reply(f'usage: {html.code("/search слова для поиска")}')
+        return
 
-    await progress.delete()
+    tag = config.history_key(message.chat.id)
+    started = time.perf_counter()
+    seqs = search_index.search(tag, command.args, limit=10)
+    found = message_store.fetch_by_seq(tag, seqs)
+    elapsed_ms = (time.perf_counter() - started) * 1000
 
-    llm_reply = await TextResponse.generate(
-        config=config,
-        chat_id=message.chat.id,
-        messages=[('system', final_prompt), ('user', final_summary)],
-    )
+    if not found:
+        await message.reply(f'ничего не нашёл ({elapsed_ms:.0f} мс)')
+        return
 
-    await info_message.delete()
+    lines = []
+    for m in found:
+        when = datetime.datetime.fromtimestamp(m.timestamp).strftime('%Y-%m-%d %H:%M')
+        text = m.text if len(m.text) <= 200 else m.text[:200] + '…'
+        author = html.bold(html.quote(m.from_full_name))
+        lines.append(f'{author} {when}\n{html.quote(text)}')
+    lines.append(html.italic(f'{len(found)} найдено за {elapsed_ms:.0f} мс'))
+    await message.reply('\n\n'.join(lines))
 
-    await message.reply(llm_reply.text)
-    await react(llm_reply.success, message)
 
+async def handle_chat_stats_command(message: types.Message, app: BotApp):
+    config = app.config
+    if not config[message.chat.id].save_messages:
+        await message.reply('🤷 я не слежу за этим чатом')
+        return
+
+    stats = analytics.fetch(config.history_key(message.chat.id), days=7)
+    lines = [html.bold(f'Статистика за {stats["days"]} дней')]
+    lines.append(f'уникальных авторов: {stats["unique_authors"]}')
+    for place, (author, count) in enumerate(stats['talkers'].most_common(10), 1):
+        lines.append(f'{place}. {html.quote(author)}: {count}')
+
+    lines.append(f'\nмоих ответов за всё время: {stats["replies"]}')
+    for provider, values in sorted(stats['providers'].items()):
+        calls = values.get('calls', 0)
+        avg_latency = values.get('latency_ms', 0) / max(calls, 1) / 1000
+        lines.append(
+            f'{provider}: {calls} вызовов, в среднем {avg_latency:.1f}с, '
+            f'{values.get("tokens", 0)} токенов'
+        )
+
+    lines.append(html.pre(render_heatmap(stats['heatmap'])))
+    await message.reply('\n'.join(lines))
 
-@router.message(F.text, config.filter_chat_allowed)
-async def handle_text_message(message: types.Message):
-    save_messages = config[message.chat.id].save_messages
-    if save_messages:
-        tag = f'matvey-3000:history:{config.me_strip_lower}:{message.chat.id}'
-        msg = StoredChatMessage.from_tg_message(message)
-        message_store.save(tag, msg)
 
-    # if last message is a single word, ignore it
-    args = message.text
-    args = args.split()
-    if len(args) == 1:
+async def handle_summary_command(
+    message: types.Message, command: types.CommandObject, app: BotApp
+):
+    config = app.config
+    try:
+        window = summary.parse_window(command.args)
+    except ValueError:
+        await message.reply(
+            'usage: /sum [количество сообщений | 6h | 2d | 1w | 2024-03-08]'
+        )
         return
 
-    message_chain = extract_message_chain(message, bot.id)
-    # print(message_chain)
-    if not any(role == 'assistant' for role, _ in message_chain):
-        # this seems... twisted. Need to double-check
-        if len(message_chain) > 1 and random.random() < 0.95:
-            # vv wtf is this comment?
-            # logging.info('podpizdnut mode fired')
-            return
-
-    if len(message_chain) == 1 and message.chat.id < 0:
-        if not any(config.me in x for x in args):
-            # nobody mentioned me, so I shut up
-            return
+    # everyone asking for the same summary at the same time gets the same reply
+    llm_reply = await singleflight.do(
+        singleflight.make_key(
+            f'{config.me_strip_lower}:{message.chat.id}',
+            'sum',
+            command.args,
+            window=300,
+        ),
+        lambda: summarize_history(app, message, window),
+        dumps=TextResponse.serialize,
+        loads=TextResponse.deserialize,
+    )
+
+    await message.reply(html.quote(llm_reply.text))
+    await react(config, llm_reply.success, message)
+
+
+async def summarize_history(
+    app: BotApp, message: types.Message, window
+) -> TextResponse:
+    config, digests = app.config, app.digests
+    tag = config.history_key(message.chat.id)
+    if window.since is None:
+        seq_range = message_store.seq_range_last(tag, window.limit)
+    else:
+        seq_range = message_store.seq_range_between(
+            tag, start_ts=window.since, end_ts=int(time.time())
+        )
+    if seq_range is None:
+        return TextResponse(success=False, text='🤷 тут нечего пересказывать')
+
+    first, last = seq_range
+    info_message = await message.answer(
+        f'🤖 Обрабатываю {last - first + 1} сообщений'
+    )
+    progress = await message.answer('Читаю историю…')
+
+    async def on_progress(entity, number):
+        await progress.edit_text(f'Обрабатываю {entity} {number}')
+        await message.chat.do('typing')
+
+    async def generate(messages, task):
+        return await generate_summary_part(
+            config, message.chat.id, messages, task, record=not app.replay
+        )
+
+    if window.since is not None and digests is not None:
+        # hours and days already summarized in the background are reused
+        llm_reply = await digests.summarize_since(
+            message.chat.id, window.since, on_progress
+        ) or TextResponse(success=False, text='🤷 тут нечего пересказывать')
     else:
-        # we are either in private messages,
-        # or there's a continuation of a thread
-        pass
+        raw_messages = message_store.iter_seq_range(tag, first, last, raw=True)
+        llm_reply = await summary.summarize(
+            texts=summary.decode_texts(raw_messages),
+            generate=generate,
+            count_tokens=summary.token_counter(
+                config.model_for_chat_id(message.chat.id)
+            ),
+            on_progress=on_progress,
+        )
 
-    messages_to_send = [
-        config.prompt_tuple_for_chat(message.chat.id),
-        *message_chain,
+    await progress.delete()
+    await info_message.delete()
+    return llm_reply
+
+
+def recall(app: BotApp, message: types.Message, message_chain) -> str | None:
+    """Earlier messages of the chat similar to this one, as a prompt addition"""
+    tag = app.config.history_key(message.chat.id)
+    hits = app.memory.search(tag, message.text)
+    if not hits:
+        return None
+    in_chain = {text for _, text in message_chain}
+    recalled = [
+        f'{m.from_full_name}: {m.text}'
+        for m in message_store.fetch_by_seq(tag, [seq for seq, _ in hits])
+        if m.text not in in_chain
     ]
+    if not recalled:
+        return None
+    metrics.inc('memory.recalled', len(recalled))
+    return 'Earlier messages in this chat that may be relevant:\n' + '\n'.join(
+        recalled
+    )
+
+
+async def finish_streamed_reply(
+    streamed: types.Message, text: str
+) -> types.Message | None:
+    """Puts the final text into a streamed reply, None if that did not work"""
+    try:
+        # same parse mode as the partial edits, and awaited so a failure
+        # is not just logged by TelegramScheduler
+        with awaited_edits():
+            await streamed.edit_text(text, parse_mode=None)
+    except TelegramAPIError as e:
+        if isinstance(e, TelegramBadRequest) and 'not modified' in e.message:
+            # the last partial edit already had the whole reply
+            return streamed
+        logger.warning('Failed to finish streamed reply: %s', e)
+        return None
+    return streamed
+
+
+async def handle_text_message(
+    message: types.Message, relevance: str, bot: Bot, app: BotApp
+):
+    # PreFilterMiddleware already saved the message and dropped everything
+    # that is not addressed to the bot, see PreFilterMiddleware.classify
+    if relevance == 'command':
+        # unknown command, not for us
+        return
+
+    config = app.config
+    message_chain = extract_message_chain(message, bot.id)
+
+    messages_to_send = [config.prompt_tuple_for_chat(message.chat.id)]
+    if app.memory is not None and config[message.chat.id].save_messages:
+        recalled = await asyncio.to_thread(recall, app, message, message_chain)
+        if recalled:
+            messages_to_send.append(('system', recalled))
+    messages_to_send.extend(message_chain)
 
     # print('chain of', len(message_chain))
     # print('in chat', message.chat.id)
 
     await message.chat.do('typing')
 
+    streamed = None
+
+    async def on_partial(text):
+        # TelegramScheduler coalesces the edits, only the latest text is sent;
+        # a half-written reply may not be valid HTML yet
+        nonlocal streamed
+        if streamed is None:
+            streamed = await message.reply(text, parse_mode=None)
+        else:
+            await streamed.edit_text(text, parse_mode=None)
+
     llm_reply = await TextResponse.generate(
         config=config,
         chat_id=message.chat.id,
         messages=messages_to_send,
+        on_partial=on_partial,
     )
     func = message.reply if llm_reply.success else message.answer
-    await func(llm_reply.text)
+    sent = None
+    if streamed is not None:
+        sent = await finish_streamed_reply(streamed, llm_reply.text)
+    if sent is None:
+        sent = await func(html.quote(llm_reply.text))
 
-    if save_messages:
+    if config[message.chat.id].save_messages and not app.replay:
         msg = StoredChatMessage(
             chat_name=message.chat.full_name,
             from_username=config.me_strip_lower,
             from_full_name='BOT',
             text=llm_reply.text,
             timestamp=int(time.time()),
+            message_id=sent.message_id,
+            reply_to=message.message_id,
         )
-        message_store.save(tag, msg)
+        app.ingest.submit(config.history_key(message.chat.id), msg)
+        analytics.record_llm_call(config.history_key(message.chat.id), llm_reply)
+
+    await react(config, llm_reply.success, message)
 
-    await react(llm_reply.success, message)
+
+def build_router(app: BotApp) -> Router:
+    config = app.config
+    router = Router(name=config.me_strip_lower)
+    router.message.filter(app.filter_own_updates)
+    admission = AdmissionController.from_config(config.admission)
+    router.message.middleware(AdmissionMiddleware(admission))
+
+    on_message = router.message.register
+    on_message(dump_message_info, Command(commands=['blerb'], ignore_mention=True))
+    on_message(
+        switch_to_claude, Command(commands=['mode_claude'], ignore_mention=True)
+    )
+    on_message(
+        switch_to_chatgpt, Command(commands=['mode_chatgpt'], ignore_mention=True)
+    )
+    on_message(
+        switch_to_yandexgpt, Command(commands=['mode_yandex'], ignore_mention=True)
+    )
+    on_message(
+        switch_provider,
+        config.filter_chat_allowed,
+        Command(commands=['mode', re.compile(r'mode_(\w+)')], ignore_mention=True),
+    )
+    on_message(
+        dump_set_prompt, config.filter_chat_allowed, Command(commands=['prompt'])
+    )
+    on_message(
+        gimme_pic,
+        config.filter_chat_allowed,
+        Command(commands=['pic']),
+        flags={'admission': 'image'},
+    )
+    on_message(
+        gimme_pikk,
+        config.filter_chat_allowed,
+        Command(commands=['pik']),
+        flags={'admission': 'image'},
+    )
+    on_message(
+        translate_ruen,
+        config.filter_chat_allowed,
+        Command(commands=['ru', 'en']),
+        flags={'admission': 'translation'},
+    )
+    on_message(
+        handle_stats_command,
+        config.filter_is_admin,
+        Command(commands=['admin_stats']),
+    )
+    on_message(
+        handle_search_command,
+        config.filter_chat_allowed,
+        Command(commands=['search']),
+    )
+    on_message(
+        handle_chat_stats_command,
+        config.filter_chat_allowed,
+        Command(commands=['stats']),
+    )
+    on_message(
+        handle_summary_command,
+        config.filter_summary_enabled,
+        Command(commands=['samari', 'sammari', 'sum', 'sosum']),
+        flags={'admission': 'summary'},
+    )
+    on_message(
+        handle_text_message,
+        F.text,
+        config.filter_chat_allowed,
+        flags={'admission': 'chat'},
+    )
+    return router
+
+
+class BotSelectorMiddleware(BaseMiddleware):
+    """
+    Outer middleware of a dispatcher shared by several bots: finds the bot an
+    update came to, passes it on as `app` and runs that bot's prefilter
+    """
+
+    def __init__(self, apps: list[BotApp]):
+        self.apps = {app.bot.id: app for app in apps}
+
+    async def __call__(self, handler, event: types.Message, data):
+        app = self.apps[data['bot'].id]
+        data['app'] = app
+        return await app.prefilter(handler, event, data)
+
+
+class ReplayRequests(BaseRequestMiddleware):
+    """
+    Session middleware for replayed history: the messages the bot replies and
+    reacts to do not exist in the target chat, so replies are sent without
+    them and reactions are skipped
+    """
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, SetMessageReaction):
+            metrics.inc('replay.reactions_skipped')
+            return True
+        if 'allow_sending_without_reply' in type(method).model_fields:
+            method.allow_sending_without_reply = True
+        return await make_request(bot, method)
+
+
+class BotHost:
+    """
+    Runs one or more bots in a single event loop.
+
+    Every bot has its own config, token, router and admission limits. The
+    redis pool, Telegram HTTP session, LLM clients, tokenizers, search index,
+    analytics, singleflight and stream workers are shared, as are retrieval
+    memories pointing at the same directory, so each extra bot adds a handful
+    of objects and asyncio tasks rather than connections and threads.
+
+    With replay=True nothing the bots see or send is saved or counted, no
+    background workers are started, see ReplayRequests for the rest.
+    """
+
+    def __init__(
+        self, configs: dict[str, Config], stream_namespace: str, replay=False
+    ):
+        self.stream_namespace = stream_namespace
+        self.replay = replay
+        self.session = AiohttpSession()
+        self.session.middleware(TelegramScheduler())
+        if replay:
+            self.session.middleware(ReplayRequests())
+        memories: dict[str, RetrievalMemory] = {}
+        self.apps = [
+            self._make_app(path, config, memories) for path, config in configs.items()
+        ]
+        self._pubsub_thread = None
+
+    @classmethod
+    def from_env(cls, replay=False) -> BotHost:
+        """
+        BOT_CONFIG_DIR hosts a bot per *.toml in that directory, otherwise the
+        one bot from BOT_CONFIG_TOML is run
+        """
+        directory = os.getenv('BOT_CONFIG_DIR')
+        if directory:
+            return cls(
+                Config.read_dir(directory),
+                stream_namespace=os.getenv('BOT_HOST_NAME', 'host'),
+                replay=replay,
+            )
+        path = os.getenv('BOT_CONFIG_TOML')
+        config = Config.read_toml(path)
+        # same stream keys as before hosting was a thing
+        return cls(
+            {path: config}, stream_namespace=config.me_strip_lower, replay=replay
+        )
+
+    def stream_key(self, name) -> str:
+        return f'matvey-3000:stream:{self.stream_namespace}:{name}'
+
+    @property
+    def bots(self) -> list[Bot]:
+        return [app.bot for app in self.apps]
+
+    def app_for(self, me: str) -> BotApp:
+        return next(app for app in self.apps if app.config.me_strip_lower == me)
+
+    def _make_app(self, path, config: Config, memories) -> BotApp:
+        token = os.getenv(config.telegram_token_env)
+        if not token:
+            raise ConfigError(f'{path}: {config.telegram_token_env} is not set')
+        bot = Bot(token=token, session=self.session, default=bot_props)
+        ingest = Ingest(
+            message_store.redis_conn,
+            stream=self.stream_key('ingest'),
+            enabled=not self.replay,
+        )
+        memory = None
+        if config.memory:
+            directory = config.memory['path']
+            if directory not in memories:
+                memories[directory] = RetrievalMemory.from_config(config.memory)
+            memory = memories[directory]
+        digests = None
+        if config.digests and not self.replay:
+            digests = DigestScheduler.from_config(
+                config,
+                message_store,
+                functools.partial(generate_summary_part, config),
+            )
+        return BotApp(
+            config=config,
+            config_path=path,
+            bot=bot,
+            ingest=ingest,
+            prefilter=PreFilterMiddleware(config, ingest),
+            image_cache=ImageCache(
+                message_store.redis_conn, namespace=config.me_strip_lower
+            ),
+            memory=memory,
+            digests=digests,
+            replay=self.replay,
+        )
+
+    def start_background_tasks(self) -> list[asyncio.Task]:
+        redis_conn = message_store.redis_conn
+        # override invalidations of all bots come through one connection
+        pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+        for app in self.apps:
+            overrides = RuntimeOverrides(
+                redis_conn, namespace=app.config.me_strip_lower
+            )
+            app.config.attach_overrides(overrides)
+            overrides.start(pubsub)
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        singleflight.start()
+        if self.replay:
+            # stream consumer groups, digests and config reloads are left to
+            # the live bots, nothing is ingested here anyway
+            return []
+
+        saved_stream = self.stream_key('saved')
+        consumers = [
+            (self.stream_key('ingest'), HistoryWriter(message_store, saved_stream)),
+            (saved_stream, SearchIndexer(search_index)),
+            (saved_stream, ActivityRecorder(analytics)),
+        ]
+        memories = {
+            app.config.me_strip_lower: app.memory
+            for app in self.apps
+            if app.memory is not None
+        }
+        if memories:
+            consumers.append((saved_stream, MemoryIndexer(memories)))
+        workers = [
+            StreamWorker(redis_conn, stream, consumer)
+            for stream, consumer in consumers
+        ]
+
+        watchers = [
+            ConfigWatcher(app.config, path=app.config_path) for app in self.apps
+        ]
+
+        def reload_all():
+            for watcher in watchers:
+                watcher.reload()
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_all)
+        tasks = [
+            *(
+                asyncio.create_task(watcher.run(handle_signals=False))
+                for watcher in watchers
+            ),
+            *(asyncio.create_task(app.ingest.run()) for app in self.apps),
+            *(asyncio.create_task(worker.run()) for worker in workers),
+        ]
+        for app in self.apps:
+            if app.digests is not None:
+                tasks.append(asyncio.create_task(app.digests.run()))
+        return tasks
+
+    def build_dispatcher(self) -> Dispatcher:
+        dp = Dispatcher()
+        dp.message.outer_middleware(BotSelectorMiddleware(self.apps))
+        for app in self.apps:
+            dp.include_router(build_router(app))
+        return dp
+
+    async def close(self):
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+        await self.session.close()
 
 
 async def main():
-    dp = Dispatcher()
-    dp.include_router(router)
-    await dp.start_polling(bot)
+    host = BotHost.from_env()
+    background_tasks = host.start_background_tasks()
+    dp = host.build_dispatcher()
+    try:
+        await dp.start_polling(*host.bots)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await host.close()
 
 
 if __name__ == '__main__':
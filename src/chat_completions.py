@@ -1,60 +1,171 @@
+from __future__ import annotations
+
 import asyncio
 import json
 import os
-import textwrap
-from dataclasses import dataclass
+import time
+from dataclasses import asdict, dataclass, replace
+from typing import TYPE_CHECKING
 
 import anthropic
 import httpx
 import openai
 
+import metrics
+import summary
+from model_router import TASK_CHAT, ModelRouter
+
+if TYPE_CHECKING:
+    from config import ProviderConfig
+
 
 openai_client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 anthro_client = anthropic.AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+# shared by every bot in the process, keeps connections to the APIs alive
+http_client = httpx.AsyncClient()
 yagpt_folder_id = os.getenv('YANDEXGPT_FOLDER_ID', default='NoYaFolder')
 yagpt_api_key = os.getenv('YANDEXGPT_API_KEY', default='NoYaKey')
 kandinski_api_key = os.getenv('KANDINSKI_API_KEY', default='KandiKeyOopsie')
 kandinski_api_secret = os.getenv('KANDINSKI_API_SECRET', default='KandiSecretOopsie')
 
+# prompt sizes only decide between routing rules, any tokenizer is good enough
+model_router = ModelRouter(count_tokens=summary.token_counter('gpt-3.5-turbo'))
+
+# streamed replies are passed on at most this often, seconds
+STREAM_UPDATE_INTERVAL = 1.0
+
+_compatible_clients: dict[ProviderConfig, openai.AsyncOpenAI] = {}
+
+
+def compatible_client(provider: ProviderConfig) -> openai.AsyncOpenAI:
+    """Client with its own connection pool per provider, kept across reloads"""
+    client = _compatible_clients.get(provider)
+    if client is None:
+        timeout = httpx.Timeout(provider.timeout, connect=provider.connect_timeout)
+        limits = httpx.Limits(
+            max_connections=provider.max_connections,
+            max_keepalive_connections=provider.max_keepalive_connections,
+        )
+        api_key = os.getenv(provider.api_key_env) if provider.api_key_env else None
+        client = openai.AsyncOpenAI(
+            # local servers usually accept anything, the client wants something
+            api_key=api_key or 'EMPTY',
+            base_url=provider.base_url,
+            timeout=timeout,
+            http_client=httpx.AsyncClient(timeout=timeout, limits=limits),
+        )
+        _compatible_clients[provider] = client
+    return client
+
+
+def anthropic_payload(messages) -> tuple[list[dict], list[dict]]:
+    """
+    (role, text) pairs -> system blocks and turns for the Messages API.
+
+    The first system prompt is marked for prompt caching, so chat personas and
+    summary prompts are not processed again on every call. Further system
+    texts, like recalled messages, change from call to call and go into
+    blocks after the cached one. Turns have to alternate and start with the
+    user, consecutive ones are merged.
+    """
+    system = [text for role, text in messages if role == 'system' and text]
+    turns = []
+    for role, text in messages:
+        if role == 'system' or not text:
+            continue
+        if turns and turns[-1]['role'] == role:
+            turns[-1]['content'] += f'\n\n{text}'
+        else:
+            turns.append({'role': role, 'content': text})
+    if turns and turns[0]['role'] != 'user':
+        # reply chain starts with a bot message
+        turns.insert(0, {'role': 'user', 'content': '…'})
+
+    blocks = [{'type': 'text', 'text': text} for text in system]
+    if blocks:
+        blocks[0]['cache_control'] = {'type': 'ephemeral'}
+    return blocks, turns
+
 
 @dataclass(frozen=True)
 class TextResponse:
     success: bool
     text: str
+    provider: str = ''
+    model: str = ''
+    tokens: int = 0
+    latency_ms: int = 0
+
+    def serialize(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @classmethod
+    def deserialize(cls, serialized: str) -> TextResponse:
+        return cls(**json.loads(serialized))
 
     @classmethod
-    async def generate(cls, config, chat_id, messages):
+    async def generate(cls, config, chat_id, messages, task=TASK_CHAT, on_partial=None):
+        """
+        on_partial(text) is awaited with the reply so far while it is generated,
+        by providers configured with stream = true
+        """
         provider = config.provider_for_chat_id(chat_id)
-        if provider == config.PROVIDER_OPENAI:
-            return await cls._generate_openai(
-                openai_client,
-                config.model_for_chat_id(chat_id),
-                messages,
+        try:
+            default_model = config.model_for_provider(provider)
+        except KeyError:
+            return cls(
+                success=False,
+                text=f'Unsupported provider: {provider}',
+                provider=provider,
             )
+        model = model_router.pick(
+            config.routing, provider, task, messages, default=default_model
+        )
+
+        started = time.monotonic()
+        response = await cls._generate_for_provider(
+            config, provider, model, messages, on_partial
+        )
+        latency_ms = int((time.monotonic() - started) * 1000)
+        model_router.record(provider, model, latency_ms, response.success)
+        return replace(response, provider=provider, model=model, latency_ms=latency_ms)
+
+    @classmethod
+    async def _generate_for_provider(
+        cls, config, provider, model, messages, on_partial=None
+    ):
+        if provider == config.PROVIDER_OPENAI:
+            return await cls._generate_openai(openai_client, model, messages)
         elif provider == config.PROVIDER_ANTHROPIC:
-            return await cls._generate_anthropic(
-                anthro_client,
-                config.model_for_chat_id(chat_id),
+            return await cls._generate_anthropic(anthro_client, model, messages)
+        elif provider == config.PROVIDER_YANDEXGPT:
+            return await cls._generate_yandexgpt(http_client, model, messages)
+        elif provider in config.providers:
+            settings = config.providers[provider]
+            return await cls._generate_openai(
+                compatible_client(settings),
+                model,
                 messages,
+                on_partial=on_partial if settings.stream else None,
             )
-        elif provider == config.PROVIDER_YANDEXGPT:
-            async with httpx.AsyncClient() as httpx_client:
-                return await cls._generate_yandexgpt(
-                    httpx_client,
-                    config.model_for_chat_id(chat_id),
-                    messages,
-                )
         else:
-            return cls(success=False, text=f'Unsupported provider: {config.provider}')
+            return cls(success=False, text=f'Unsupported provider: {provider}')
 
     @classmethod
-    async def _generate_openai(cls, client, model, messages):
+    async def _generate_openai(cls, client, model, messages, on_partial=None):
         payload = [{'role': role, 'content': text} for role, text in messages]
         try:
-            response = await client.chat.completions.create(
-                model=model,
-                messages=payload,
-            )
+            if on_partial is not None:
+                text, tokens = await cls._stream_openai(
+                    client, model, payload, on_partial
+                )
+            else:
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=payload,
+                )
+                text = response.choices[0].message.content
+                tokens = response.usage.total_tokens if response.usage else 0
         except openai.RateLimitError as e:
             return cls(
                 success=False,
@@ -65,73 +176,87 @@ class TextResponse:
                 success=False,
                 text=f'Beep-bop, кажется я не умею отвечать на такие вопросы:\n\n{e}',  # noqa
             )
-        except TimeoutError as e:
+        except (TimeoutError, openai.APIConnectionError) as e:
             return cls(
                 success=False,
                 text=f'Кажется у меня сбоит сеть. Ты попробуй позже, а я пока схожу чаю выпью.\n\n{e}',  # noqa
             )
-        else:
+        except openai.APIStatusError as e:
             return cls(
-                success=True,
-                text=response.choices[0].message.content,
+                success=False,
+                text=f'Что-то сломалось на той стороне, попробуй позже.\n\n{e}',
             )
+        else:
+            return cls(success=True, text=text, tokens=tokens)
 
-    @classmethod
-    async def _generate_anthropic(cls, client, model, messages):
-        user_tag = anthropic.HUMAN_PROMPT
-        bot_tag = anthropic.AI_PROMPT
-        system = [text for role, text in messages if role == 'system'][0]
-
-        # claude 2.1 might need different format for prompting since it has system prompts
-        # full_prompt = f'{system} {user_tag}{human}{bot_tag}'
-
-        # claude instant 1.2 though... Needs a different thing
-        prompt = textwrap.dedent(
-            """
-                Here are a few back and forth messages between user and a bot.
-                User messages are in tag <user>, bot messages are in tag <bot>
-            """.strip()
-        )
-        prompt = [f'{user_tag}{prompt}']
-        for role, text in messages:
-            if role == 'system':
-                continue
-            prompt.append(f'\n<{role}>{text}</{role}>')
-        prompt.append(f'\n{system}')
-        prompt.append(
-            '\nTake content of last unpaired "user" and use this as completion prompt.'
+    @staticmethod
+    async def _stream_openai(client, model, payload, on_partial) -> tuple[str, int]:
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=payload,
+            stream=True,
         )
-        prompt.append(f'\nRespond ONLY with text and no tags.{bot_tag}')
-        prompt = ''.join(prompt)
+        parts = []
+        tokens = 0
+        next_update = time.monotonic() + STREAM_UPDATE_INTERVAL
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            # some servers report usage in the last chunk, the client
+            # version we pin does not know the field and keeps it as a dict
+            usage = getattr(chunk, 'usage', None)
+            if isinstance(usage, dict):
+                tokens = usage.get('total_tokens', 0)
+            elif usage:
+                tokens = usage.total_tokens
+            if parts and time.monotonic() >= next_update:
+                next_update = time.monotonic() + STREAM_UPDATE_INTERVAL
+                await on_partial(''.join(parts))
+        return ''.join(parts), tokens
 
-        # print(prompt)
+    @classmethod
+    async def _generate_anthropic(cls, client, model, messages):
+        system, turns = anthropic_payload(messages)
         try:
-            response = await client.completions.create(
+            response = await client.messages.create(
                 model=model,
-                max_tokens_to_sample=1024,  # no clue about this value
-                prompt=prompt,
+                max_tokens=1024,  # no clue about this value
+                system=system,
+                messages=turns,
             )
-        except openai.RateLimitError as e:
+        except anthropic.RateLimitError as e:
             return cls(
                 success=False,
                 text=f'Кажется я подустал и воткнулся в рейт-лимит. Давай сделаем перерыв ненадолго.\n\n{e}',  # noqa
             )
-        except openai.BadRequestError as e:
+        except anthropic.BadRequestError as e:
             return cls(
                 success=False,
                 text=f'Beep-bop, кажется я не умею отвечать на такие вопросы:\n\n{e}',  # noqa
             )
-        except TimeoutError as e:
+        except (anthropic.APITimeoutError, anthropic.APIConnectionError) as e:
             return cls(
                 success=False,
                 text=f'Кажется у меня сбоит сеть. Ты попробуй позже, а я пока схожу чаю выпью.\n\n{e}',  # noqa
             )
+        except anthropic.APIStatusError as e:
+            # 5xx and 529 overloaded
+            return cls(
+                success=False,
+                text=f'У антропика что-то сломалось, попробуй позже.\n\n{e}',
+            )
         else:
-            # print(response.completion)
-            completion = response.completion.replace("<", "[").replace(">", "]")
+            usage = response.usage
+            cached = getattr(usage, 'cache_read_input_tokens', None) or 0
+            written = getattr(usage, 'cache_creation_input_tokens', None) or 0
+            metrics.inc('anthropic.cache_read_tokens', cached)
+            metrics.inc('anthropic.cache_write_tokens', written)
             return cls(
                 success=True,
-                text=completion,
+                text=''.join(
+                    block.text for block in response.content if block.type == 'text'
+                ),
+                tokens=usage.input_tokens + usage.output_tokens + cached + written,
             )
 
     @classmethod
@@ -159,6 +284,7 @@ class TextResponse:
             return cls(
                 success=True,
                 text=data['result']['alternatives'][0]['message']['text'],
+                tokens=int(data['result'].get('usage', {}).get('totalTokens', 0)),
             )
         else:
             return cls(
@@ -173,18 +299,22 @@ class ImageResponse:
     b64_or_url: str
     censored: bool = False
 
+    SIZE = '512x512'
+
+    def serialize(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def deserialize(cls, serialized: str) -> ImageResponse:
+        return cls(**json.loads(serialized))
+
     @classmethod
     async def generate(cls, prompt, mode='dall-e'):
         if mode == 'dall-e':
             # no other providers yet so meh
-            openai_client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
             return await cls._generate_dalle(openai_client, prompt)
         elif mode == 'kandinski':
-            async with httpx.AsyncClient() as httpx_client:
-                return await cls._generate_kandinski(
-                    httpx_client,
-                    prompt,
-                )
+            return await cls._generate_kandinski(http_client, prompt)
         else:
             return cls(success=False, text=f'Unsupported provider: {mode}')
 
@@ -193,7 +323,7 @@ class ImageResponse:
         img_gen_reply = await client.images.generate(
             prompt=prompt,
             n=1,
-            size='512x512',
+            size=cls.SIZE,
         )
         return cls(success=True, b64_or_url=img_gen_reply.data[0].url)
 
@@ -211,10 +341,11 @@ class ImageResponse:
         )
         # 2024jan09: only one model supported at the moment anyway
         model_id = response.json()[0]['id']
+        width, height = map(int, cls.SIZE.split('x'))
         params = {
             'type': 'GENERATE',
-            'width': 512,
-            'height': 512,
+            'width': width,
+            'height': height,
             'num_images': 1,
             'generateParams': {
                 'query': prompt,
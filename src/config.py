@@ -1,13 +1,30 @@
 from __future__ import annotations
 
+import asyncio
+import dataclasses
 import functools
+import logging
 import os
 import pathlib
+import signal
 import tomllib
 from dataclasses import dataclass
+from typing import TYPE_CHECKING
 
+from model_router import RoutingRule
 
-@dataclass
+if TYPE_CHECKING:
+    from overrides import RuntimeOverrides
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(slots=True)
 class ChatConfig:
     chat_id: int
     prompt: str
@@ -19,14 +36,49 @@ class ChatConfig:
     summary_enabled: bool = False
 
 
+@dataclass(frozen=True)
+class ProviderConfig:
+    """
+    One [providers.<name>] table of the config: an OpenAI-compatible server
+    such as vLLM or llama.cpp, usable as a provider like the built-in ones.
+
+    api_key_env: variable holding the API key, servers without auth get a dummy
+    timeout, connect_timeout: seconds, per request and for connecting
+    max_connections, max_keepalive_connections: connection pool limits
+    stream: show replies in chat as they are generated
+    """
+
+    name: str
+    base_url: str
+    model: str
+    type: str = 'openai-compatible'
+    api_key_env: str | None = None
+    timeout: float = 60.0
+    connect_timeout: float = 5.0
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    stream: bool = False
+
+    TYPES = ('openai-compatible',)
+
+    @classmethod
+    def from_dict(cls, name: str, values: dict) -> ProviderConfig:
+        provider = cls(name=name, **values)
+        if provider.type not in cls.TYPES:
+            raise ValueError(f'unknown provider type {provider.type}')
+        return provider
+
+
 @dataclass
 class Config:
     me: str
     version: int
-    configs: ChatConfig
+    configs: dict[int, ChatConfig]
     default_prompt: str
     default_provider: str
-    allowed_chat_id: list[int]
+    allowed_chat_id: frozenset[int]
+    admin_chat_id: frozenset[int]
+    summary_chat_id: frozenset[int]
 
     git_sha: str
 
@@ -39,20 +91,63 @@ class Config:
     positive_emojis: str
     negative_emojis: str
 
+    overrides: RuntimeOverrides | None = None
+    telegram_token_env: str = 'TELEGRAM_API_TOKEN'
+    admission: dict[str, dict] = dataclasses.field(default_factory=dict)
+    routing: tuple[RoutingRule, ...] = ()
+    memory: dict = dataclasses.field(default_factory=dict)
+    digests: dict = dataclasses.field(default_factory=dict)
+    providers: dict[str, ProviderConfig] = dataclasses.field(default_factory=dict)
+
     PROVIDER_OPENAI = 'openai'
     PROVIDER_ANTHROPIC = 'anthropic'
     PROVIDER_YANDEXGPT = 'yandexgpt'
+    BUILTIN_PROVIDERS = (PROVIDER_OPENAI, PROVIDER_ANTHROPIC, PROVIDER_YANDEXGPT)
 
     @classmethod
     def read_toml(cls, path) -> Config:
         with pathlib.Path(path).open('rb') as fp:
             config = tomllib.load(fp)
 
+        try:
+            return cls._from_dict(config)
+        except ConfigError:
+            raise
+        except KeyError as e:
+            raise ConfigError(f'{path}: missing required key {e}') from e
+        except (AttributeError, TypeError, ValueError) as e:
+            # right keys, wrong types: prompt = 5, allowed = "x" and the like
+            raise ConfigError(f'{path}: invalid value: {e!r}') from e
+
+    @classmethod
+    def read_dir(cls, path) -> dict[str, Config]:
+        """Configs of all bots hosted in one process, one *.toml per bot"""
+        configs = {
+            str(toml_path): cls.read_toml(toml_path)
+            for toml_path in sorted(pathlib.Path(path).glob('*.toml'))
+        }
+        if not configs:
+            raise ConfigError(f'{path}: no *.toml bot configs found')
+        for attr in ('me_strip_lower', 'telegram_token_env'):
+            seen = {}
+            for toml_path, config in configs.items():
+                value = getattr(config, attr)
+                if value in seen:
+                    raise ConfigError(
+                        f'{toml_path} and {seen[value]} have the same {attr}: {value}'
+                    )
+                seen[value] = toml_path
+        return configs
+
+    @classmethod
+    def _from_dict(cls, config) -> Config:
         default_prompt = config['defaults']['prompt']
         default_provider = config['defaults']['provider']
-        allowed_chat_ids = [chat['id'] for chat in config['chats']['allowed']]
-        per_chat_configs = {
-            chat['id']: ChatConfig(
+        per_chat_configs = {}
+        for chat in config['chats']['allowed']:
+            if chat['id'] in per_chat_configs:
+                raise ConfigError(f'chat id {chat["id"]} is configured twice')
+            per_chat_configs[chat['id']] = ChatConfig(
                 chat_id=chat['id'],
                 prompt=chat.get('prompt', default_prompt).strip(),
                 provider=chat.get('provider', default_provider),
@@ -62,18 +157,38 @@ class Config:
                 save_messages=chat.get('save_messages', False),
                 summary_enabled=chat.get('summary_enabled', False),
             )
-            for chat in config['chats']['allowed']
-        }
+
+        routing = []
+        for number, rule in enumerate(config.get('routing', []), start=1):
+            try:
+                routing.append(RoutingRule.from_dict(rule))
+            except (KeyError, TypeError, ValueError) as e:
+                raise ConfigError(f'routing rule #{number} is invalid: {e}') from e
+
+        providers = {}
+        for name, values in config.get('providers', {}).items():
+            try:
+                providers[name] = ProviderConfig.from_dict(name, values)
+            except (TypeError, ValueError) as e:
+                raise ConfigError(f'provider {name} is invalid: {e}') from e
 
         git_sha = os.getenv('GIT_SHA_ENV', 'Unknown')
 
-        return cls(
+        new_config = cls(
             me=config['me'],
             version=config['version'],
             configs=per_chat_configs,
             default_prompt=default_prompt,
             default_provider=default_provider,
-            allowed_chat_id=allowed_chat_ids,
+            allowed_chat_id=frozenset(per_chat_configs),
+            admin_chat_id=frozenset(
+                chat_id for chat_id, c in per_chat_configs.items() if c.is_admin
+            ),
+            summary_chat_id=frozenset(
+                chat_id
+                for chat_id, c in per_chat_configs.items()
+                if c.summary_enabled
+            ),
             git_sha=git_sha,
             model_chatgpt=config['models']['chatgpt'],
             model_anthropic=config['models']['anthropic'],
@@ -82,7 +197,47 @@ class Config:
             ru_to_en_prompt=config['translations']['ru_to_en'],
             positive_emojis=config['positive_emojis'],
             negative_emojis=config['negative_emojis'],
+            admission=config.get('admission', {}),
+            routing=tuple(routing),
+            memory=config.get('memory', {}),
+            digests=config.get('digests', {}),
+            providers=providers,
+            telegram_token_env=config.get('telegram_token_env', 'TELEGRAM_API_TOKEN'),
         )
+        new_config.validate()
+        return new_config
+
+    def validate(self) -> None:
+        if clash := set(self.BUILTIN_PROVIDERS) & set(self.providers):
+            raise ConfigError(f'providers shadow built-in ones: {", ".join(clash)}')
+        known = set(self.provider_names)
+        used = {
+            self.default_provider,
+            *(c.provider for c in self.configs.values()),
+            *(rule.provider for rule in self.routing),
+        }
+        if unknown := used - known:
+            raise ConfigError(f'unknown providers: {", ".join(sorted(unknown))}')
+        if not isinstance(self.me, str):
+            raise ConfigError('me must be a string')
+        if not self.positive_emojis or not self.negative_emojis:
+            raise ConfigError('positive_emojis and negative_emojis cannot be empty')
+
+    def update_from(self, fresh: Config) -> None:
+        """
+        Swap freshly parsed config into this instance, keeping runtime overrides.
+
+        There are no awaits in here, so concurrently running handlers see either
+        the old or the new config, never a mix of both.
+        """
+        overrides = self.overrides
+        for field in dataclasses.fields(self):
+            setattr(self, field.name, getattr(fresh, field.name))
+        self.overrides = overrides
+        self.__dict__.pop('me_strip_lower', None)
+        if overrides is not None:
+            for chat_id, fields in overrides.items():
+                self.apply_overrides(chat_id, fields)
 
     def __getitem__(self, chat_id) -> ChatConfig:
         return self.configs[chat_id]
@@ -94,7 +249,20 @@ class Config:
     def me_strip_lower(self):
         return self.me.lstrip('@').lower()
 
+    def history_key(self, chat_id) -> str:
+        return f'matvey-3000:history:{self.me_strip_lower}:{chat_id}'
+
+    @staticmethod
+    def bot_of_history_key(tag: str) -> str:
+        return tag.split(':', 3)[2]
+
+    @property
+    def provider_names(self) -> list[str]:
+        return [*self.BUILTIN_PROVIDERS, *sorted(self.providers)]
+
     def model_for_provider(self, provider):
+        if provider in self.providers:
+            return self.providers[provider].model
         # this should be per-chat setting???
         return {
             self.PROVIDER_OPENAI: self.model_chatgpt,
@@ -106,13 +274,32 @@ class Config:
         return message.chat.id in self.allowed_chat_id
 
     async def filter_is_admin(self, message) -> bool:
-        return self[message.chat.id].is_admin
+        return message.chat.id in self.admin_chat_id
 
     async def filter_summary_enabled(self, message) -> bool:
-        return self[message.chat.id].summary_enabled
+        return message.chat.id in self.summary_chat_id
+
+    def attach_overrides(self, overrides: RuntimeOverrides) -> None:
+        self.overrides = overrides
+        overrides.add_listener(self.apply_overrides)
+        overrides.load_all()
+
+    def apply_overrides(self, chat_id, fields) -> None:
+        chat_config = self.configs.get(chat_id)
+        if chat_config is None:
+            return
+        if 'prompt' in fields:
+            chat_config.prompt = fields['prompt']
+        if 'provider' in fields:
+            chat_config.provider = fields['provider']
 
     def override_prompt_for_chat(self, chat_id, new_prompt) -> bool:
-        self.configs[chat_id].prompt = new_prompt
+        chat_config = self.configs[chat_id]
+        # redis first, so a failed write leaves no instance out of sync
+        if self.overrides is not None:
+            if not self.overrides.set(chat_id, prompt=new_prompt):
+                return False
+        chat_config.prompt = new_prompt
         return True
 
     def rich_info(self, chat_id) -> str:
@@ -136,8 +323,13 @@ class Config:
     def provider_for_chat_id(self, chat_id) -> str:
         return self.configs[chat_id].provider
 
-    def override_provider_for_chat_id(self, chat_id, new_provider) -> str:
-        self.configs[chat_id].provider = new_provider
+    def override_provider_for_chat_id(self, chat_id, new_provider) -> bool:
+        chat_config = self.configs[chat_id]
+        if self.overrides is not None:
+            if not self.overrides.set(chat_id, provider=new_provider):
+                return False
+        chat_config.provider = new_provider
+        return True
 
     def model_for_chat_id(self, chat_id) -> str:
         provider = self.provider_for_chat_id(chat_id)
@@ -151,3 +343,58 @@ class Config:
             target_language
         )
         return ('system', prompt)
+
+
+class ConfigWatcher:
+    """Reloads config from disk when the file changes or on SIGHUP"""
+
+    def __init__(self, config: Config, path, poll_interval: float = 5.0):
+        self.config = config
+        self.path = pathlib.Path(path)
+        self.poll_interval = poll_interval
+        self._mtime = self._current_mtime()
+
+    def _current_mtime(self) -> float | None:
+        try:
+            return self.path.stat().st_mtime
+        except OSError:
+            return None
+
+    def reload(self) -> bool:
+        try:
+            fresh = Config.read_toml(self.path)
+        except (OSError, tomllib.TOMLDecodeError, ConfigError) as e:
+            logger.error('Config reload failed, keeping the current one: %s', e)
+            return False
+
+        if fresh.me != self.config.me:
+            logger.error(
+                'Config reload failed: changing me from %s to %s requires a restart',
+                self.config.me,
+                fresh.me,
+            )
+            return False
+
+        self.config.update_from(fresh)
+        logger.info(
+            'Config reloaded from %s: version %s, %d chats',
+            self.path,
+            fresh.version,
+            len(fresh),
+        )
+        return True
+
+    async def run(self, handle_signals: bool = True):
+        if handle_signals:
+            # when several configs are watched, the caller handles SIGHUP once
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            mtime = self._current_mtime()
+            if mtime is not None and mtime != self._mtime:
+                self._mtime = mtime
+                try:
+                    self.reload()
+                except Exception:
+                    # keep watching, the next edit may well fix it
+                    logger.exception('Config reload failed unexpectedly')
@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import time
+import uuid
+
+import metrics
+import summary
+from chat_completions import TextResponse
+from config import Config
+from message_store import MessageStore
+from tg_scheduler import RateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+
+
+class DigestFailed(Exception):
+    pass
+
+
+def hour_start(ts: float) -> int:
+    return int(ts // HOUR * HOUR)
+
+
+def day_start(ts: float) -> int:
+    """Local midnight of the day `ts` falls into"""
+    date = datetime.datetime.fromtimestamp(ts).date()
+    return int(datetime.datetime.combine(date, datetime.time()).timestamp())
+
+
+def next_day_start(ts: float) -> int:
+    date = datetime.datetime.fromtimestamp(ts).date() + datetime.timedelta(days=1)
+    return int(datetime.datetime.combine(date, datetime.time()).timestamp())
+
+
+class DigestScheduler:
+    """
+    Keeps rolling digests of chats with summary_enabled, so /sum mostly glues
+    together what is already summarized.
+
+    Every completed hour of a chat gets a partial summary (an empty one if
+    nobody wrote anything), and every completed day gets one made out of its
+    hours. They live in two hashes per chat, keyed by the bucket start:
+
+      <digest>:hour   hash   hour start ts -> partial summary (kept `keep_hours`)
+      <digest>:day    hash   local midnight ts -> partial summary (`keep_days`)
+      <digest>:final:<sha1>  final summaries of recent /sum requests
+
+    The last completed hour is summarized right away. Catching up on older
+    hours and daily rollups only happens during `offpeak_hours`. All calls
+    go through a per-provider budget of `calls_per_minute`.
+
+    A chat is updated by one replica at a time. Its lock is extended after
+    every digest written, so a long off-peak catch-up keeps it.
+    """
+
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    REFRESH_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        message_store: MessageStore,
+        generate,
+        interval: float = 300,
+        offpeak_hours: tuple[int, ...] = (2, 3, 4, 5, 6),
+        calls_per_minute: float = 6,
+        keep_hours: int = 8 * 24,
+        keep_days: int = 90,
+        final_ttl: int = HOUR,
+    ):
+        self.config = config
+        self.message_store = message_store
+        self.redis_conn = message_store.redis_conn
+        self.generate = generate
+        self.interval = interval
+        self.offpeak_hours = frozenset(offpeak_hours)
+        self.calls_per_minute = calls_per_minute
+        self.keep_hours = keep_hours
+        self.keep_days = keep_days
+        self.final_ttl = final_ttl
+        self._budgets: dict[str, RateLimiter] = {}
+        self._token = uuid.uuid4().hex
+        self._release = self.redis_conn.register_script(self.RELEASE_SCRIPT)
+        self._refresh = self.redis_conn.register_script(self.REFRESH_SCRIPT)
+
+    @classmethod
+    def from_config(
+        cls, config: Config, message_store: MessageStore, generate
+    ) -> DigestScheduler:
+        settings = config.digests
+        return cls(
+            config,
+            message_store,
+            generate,
+            interval=settings.get('interval', 300),
+            offpeak_hours=tuple(settings.get('offpeak_hours', (2, 3, 4, 5, 6))),
+            calls_per_minute=settings.get('calls_per_minute', 6),
+        )
+
+    @staticmethod
+    def key(tag: str, name: str) -> str:
+        return f'{tag.replace(":history:", ":digest:", 1)}:{name}'
+
+    def offpeak(self, now: float) -> bool:
+        return time.localtime(now).tm_hour in self.offpeak_hours
+
+    async def _generate(self, chat_id, messages, task) -> TextResponse:
+        provider = self.config.provider_for_chat_id(chat_id)
+        budget = self._budgets.get(provider)
+        if budget is None:
+            budget = RateLimiter(self.calls_per_minute / 60)
+            self._budgets[provider] = budget
+        await asyncio.sleep(budget.reserve())
+        reply = await self.generate(chat_id, messages, task)
+        if not reply.success:
+            # do not store error messages as digests, try again next round
+            raise DigestFailed(reply.text)
+        metrics.inc('digests.llm_calls')
+        return reply
+
+    def _condense(self, chat_id, texts, pause=0.0):
+        return summary.condense(
+            texts,
+            lambda messages, task: self._generate(chat_id, messages, task),
+            summary.token_counter(self.config.model_for_chat_id(chat_id)),
+            pause=pause,
+        )
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for chat_id in sorted(self.config.summary_chat_id):
+                try:
+                    await self.update_chat(chat_id)
+                except DigestFailed as e:
+                    logger.warning('Digest for %s failed: %s', chat_id, e)
+                except Exception:
+                    logger.exception('Digest for %s failed', chat_id)
+
+    async def update_chat(self, chat_id, now: float | None = None):
+        now = time.time() if now is None else now
+        tag = self.config.history_key(chat_id)
+        lock = self.key(tag, 'lock')
+        # one replica at a time, the others skip this chat until next round
+        if not self.redis_conn.set(lock, self._token, nx=True, ex=self.lock_ttl):
+            return
+        try:
+            await self._update_hours(chat_id, tag, now)
+            if self.offpeak(now):
+                await self._update_days(chat_id, tag, now)
+            self._trim(tag, now)
+        finally:
+            self._release(keys=[lock], args=[self._token])
+
+    @property
+    def lock_ttl(self) -> int:
+        return int(self.interval * 2)
+
+    def _keep_lock(self, tag):
+        if not self._refresh(
+            keys=[self.key(tag, 'lock')], args=[self._token, self.lock_ttl]
+        ):
+            # another replica took over the chat, leave the rest to it
+            raise DigestFailed('lost the digest lock')
+
+    async def _update_hours(self, chat_id, tag, now):
+        current = hour_start(now)
+        hours = list(range(current - self.keep_hours * HOUR, current, HOUR))
+        if not self.offpeak(now):
+            # off-peak only catch-up, except for the hour that just ended
+            hours = hours[-1:]
+        key = self.key(tag, 'hour')
+        done = self.redis_conn.hmget(key, hours)
+        for hour, digest in zip(hours, done):
+            if digest is not None:
+                continue
+            seq_range = self.message_store.seq_range_between(
+                tag, hour, hour + HOUR - 1
+            )
+            text = ''
+            if seq_range is not None:
+                raw = self.message_store.iter_seq_range(tag, *seq_range, raw=True)
+                parts = await self._condense(chat_id, summary.decode_texts(raw))
+                text = '\n'.join(parts)
+            self.redis_conn.hset(key, hour, text)
+            metrics.inc('digests.hours')
+            self._keep_lock(tag)
+
+    async def _update_days(self, chat_id, tag, now):
+        hour_key, day_key = self.key(tag, 'hour'), self.key(tag, 'day')
+        today = day_start(now)
+        day = day_start(now - self.keep_hours * HOUR + 86400)
+        while day < today:
+            next_day = next_day_start(day)
+            if self.redis_conn.hget(day_key, day) is None:
+                hours = list(range(day, next_day, HOUR))
+                texts = self.redis_conn.hmget(hour_key, hours)
+                if all(text is not None for text in texts):
+                    texts = [t.decode() for t in texts if t]
+                    parts = await self._condense(chat_id, summary._aiter(texts))
+                    self.redis_conn.hset(day_key, day, '\n'.join(parts))
+                    metrics.inc('digests.days')
+                    self._keep_lock(tag)
+            day = next_day
+
+    def _trim(self, tag, now):
+        keep = {'hour': self.keep_hours * HOUR, 'day': self.keep_days * 86400}
+        for name, seconds in keep.items():
+            key = self.key(tag, name)
+            old = [ts for ts in self.redis_conn.hkeys(key) if int(ts) < now - seconds]
+            if old:
+                self.redis_conn.hdel(key, *old)
+
+    def plan(self, tag: str, since: int, now: float) -> list[tuple]:
+        """
+        Pieces covering since..now, oldest first: ('day' | 'hour', start, text)
+        for buckets that are already summarized and ('raw', first_seq, last_seq)
+        for the messages in between that are not
+        """
+        first_hour = -(-since // HOUR) * HOUR
+        current = hour_start(now)
+        hours = list(range(first_hour, current, HOUR))
+        midnights = [h for h in hours if day_start(h) == h]
+        hourly = dict(zip(hours, self.redis_conn.hmget(self.key(tag, 'hour'), hours)))
+        daily = dict(
+            zip(midnights, self.redis_conn.hmget(self.key(tag, 'day'), midnights))
+        )
+
+        pieces = []
+
+        def add_raw(start, end):
+            seq_range = self.message_store.seq_range_between(tag, start, end - 1)
+            if seq_range is not None:
+                pieces.append(('raw', *seq_range))
+
+        covered_until = since
+        hour = first_hour
+        while hour < current:
+            next_day = next_day_start(hour)
+            if daily.get(hour) is not None and next_day <= current:
+                add_raw(covered_until, hour)
+                pieces.append(('day', hour, daily[hour].decode()))
+                hour = covered_until = next_day
+                continue
+            if hourly.get(hour) is not None:
+                add_raw(covered_until, hour)
+                pieces.append(('hour', hour, hourly[hour].decode()))
+                covered_until = hour + HOUR
+            hour += HOUR
+        add_raw(covered_until, int(now) + 1)
+        return [piece for piece in pieces if piece[0] == 'raw' or piece[2]]
+
+    async def summarize_since(
+        self, chat_id, since: int, on_progress=None, now: float | None = None
+    ) -> TextResponse | None:
+        """
+        Final summary of everything since `since`: digests are used as they are,
+        only messages not covered by them are summarized now. Returns None when
+        there is nothing to summarize.
+        """
+        now = time.time() if now is None else now
+        tag = self.config.history_key(chat_id)
+        pieces = self.plan(tag, since, now)
+        if not pieces:
+            return None
+
+        # digests are identified by their bucket, raw pieces by their seq range
+        fingerprint = repr([p if p[0] == 'raw' else p[:2] for p in pieces])
+        digest = hashlib.sha1(fingerprint.encode()).hexdigest()
+        final_key = self.key(tag, f'final:{digest}')
+        cached = self.redis_conn.get(final_key)
+        if cached is not None:
+            metrics.inc('digests.final_cached')
+            return TextResponse.deserialize(cached.decode())
+
+        async def generate(messages, task):
+            return await self.generate(chat_id, messages, task)
+
+        count_tokens = summary.token_counter(self.config.model_for_chat_id(chat_id))
+        summaries = []
+        for kind, *rest in pieces:
+            if kind != 'raw':
+                summaries.append(rest[1])
+                continue
+            raw = self.message_store.iter_seq_range(tag, *rest, raw=True)
+            summaries.extend(
+                await summary.condense(
+                    summary.decode_texts(raw), generate, count_tokens, on_progress
+                )
+            )
+        metrics.inc('digests.pieces_reused', sum(1 for p in pieces if p[0] != 'raw'))
+
+        reply = await summary.reduce(summaries, generate, count_tokens, on_progress)
+        if reply.success:
+            self.redis_conn.set(final_key, reply.serialize(), ex=self.final_ttl)
+        return reply
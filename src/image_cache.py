@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+
+import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """
+    Telegram file_id of already generated and uploaded images.
+
+    file_id is only valid for the bot that uploaded the file, hence the
+    namespace. Sending a known file_id needs no generation and no upload.
+    """
+
+    def __init__(
+        self, redis_conn: redis.Redis, namespace: str, ttl: int = 30 * 86400
+    ):
+        self.redis_conn = redis_conn
+        self.key_prefix = f'matvey-3000:imgcache:{namespace}'
+        self.ttl = ttl
+
+    @staticmethod
+    def normalize_prompt(prompt: str | None) -> str:
+        return ' '.join((prompt or '').lower().split()).strip(' .!?')
+
+    def key(self, provider: str, prompt: str | None, size: str) -> str:
+        normalized = self.normalize_prompt(prompt)
+        digest = hashlib.sha1(normalized.encode()).hexdigest()
+        return f'{self.key_prefix}:{provider}:{size}:{digest}'
+
+    def get(self, provider: str, prompt: str | None, size: str) -> str | None:
+        try:
+            file_id = self.redis_conn.get(self.key(provider, prompt, size))
+        except redis.RedisError:
+            logger.exception('Image cache lookup failed')
+            return None
+        return file_id.decode() if file_id is not None else None
+
+    def put(self, provider: str, prompt: str | None, size: str, file_id: str):
+        try:
+            self.redis_conn.set(self.key(provider, prompt, size), file_id, ex=self.ttl)
+        except redis.RedisError:
+            logger.exception('Image cache store failed')
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+from typing import TYPE_CHECKING
+
+import redis
+
+import metrics
+from analytics import ChatAnalytics
+from config import Config
+from message_store import MessageStore, StoredChatMessage
+from search_index import SearchIndex
+from streams import StreamConsumer, StreamEntry
+
+if TYPE_CHECKING:
+    from memory import RetrievalMemory
+
+
+logger = logging.getLogger(__name__)
+
+
+class Ingest:
+    """
+    Moves history writes off the handler path.
+
+    Handlers only put messages into an in-memory queue, a background task drains
+    it in batches and appends them to the ingest stream in one pipelined round
+    trip. Everything else happens in stream consumers: HistoryWriter saves
+    messages and announces them on the saved stream, where the search index,
+    activity counters and retrieval memory pick them up.
+    """
+
+    STREAM_MAXLEN = 100000
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        stream: str,
+        max_queue_size: int = 10000,
+        batch_size: int = 100,
+        enabled: bool = True,
+    ):
+        self.redis_conn = redis_conn
+        self.stream = stream
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.queue: asyncio.Queue[tuple[str, StoredChatMessage]] = asyncio.Queue(
+            maxsize=max_queue_size
+        )
+
+    def submit(self, tag: str, message: StoredChatMessage) -> bool:
+        if not self.enabled:
+            metrics.inc('ingest.disabled')
+            return False
+        try:
+            self.queue.put_nowait((tag, message))
+        except asyncio.QueueFull:
+            metrics.inc('ingest.dropped')
+            logger.warning('Ingest queue is full, dropping message for %s', tag)
+            return False
+        metrics.inc('ingest.submitted')
+        return True
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await asyncio.to_thread(self._append, batch)
+            except Exception:
+                metrics.inc('ingest.failed', len(batch))
+                logger.exception('Failed to append %d messages', len(batch))
+            else:
+                metrics.inc('ingest.appended', len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _append(self, batch: list[tuple[str, StoredChatMessage]]):
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for tag, message in batch:
+                pipe.xadd(
+                    self.stream,
+                    {'tag': tag, 'message': message.serialize()},
+                    maxlen=self.STREAM_MAXLEN,
+                    approximate=True,
+                )
+            pipe.execute()
+
+
+class HistoryWriter(StreamConsumer):
+    """Saves ingested messages, duplicates are dropped by MessageStore"""
+
+    group = 'history'
+
+    def __init__(self, message_store: MessageStore, saved_stream: str):
+        self.message_store = message_store
+        self.saved_stream = saved_stream
+
+    def handle(self, entries: list[StreamEntry]):
+        seqs = self.message_store.save_many(
+            [(entry.tag, entry.message) for entry in entries],
+            saved_stream=self.saved_stream,
+        )
+        saved = sum(1 for seq in seqs if seq >= 0)
+        metrics.inc('ingest.saved', saved)
+        if saved < len(entries):
+            metrics.inc('ingest.duplicates', len(entries) - saved)
+
+
+class SearchIndexer(StreamConsumer):
+    group = 'search'
+
+    def __init__(self, search_index: SearchIndex):
+        self.search_index = search_index
+
+    def handle(self, entries: list[StreamEntry]):
+        self.search_index.index_many(
+            [(entry.tag, entry.seq, entry.message.text) for entry in entries]
+        )
+
+
+class ActivityRecorder(StreamConsumer):
+    group = 'analytics'
+
+    def __init__(self, analytics: ChatAnalytics):
+        self.analytics = analytics
+
+    def handle(self, entries: list[StreamEntry]):
+        self.analytics.record_messages(
+            [(entry.tag, entry.message) for entry in entries]
+        )
+
+
+class MemoryIndexer(StreamConsumer):
+    """`memories` maps bot names to their memory, other bots are skipped"""
+
+    group = 'memory'
+
+    def __init__(self, memories: dict[str, RetrievalMemory]):
+        self.memories = memories
+
+    def handle(self, entries: list[StreamEntry]):
+        per_memory = collections.defaultdict(list)
+        for entry in entries:
+            memory = self.memories.get(Config.bot_of_history_key(entry.tag))
+            if memory is not None:
+                per_memory[memory].append((entry.tag, entry.seq, entry.message.text))
+        for memory, items in per_memory.items():
+            memory.index_many(items)
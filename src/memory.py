@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import fcntl
+import logging
+import math
+import os
+import pathlib
+import threading
+import zlib
+
+import numpy as np
+
+import metrics
+from search_index import tokenize
+
+
+logger = logging.getLogger(__name__)
+
+
+class HashingEmbedder:
+    """
+    Offline embedder: search terms are hashed into `dim` buckets with a random
+    sign, weighted by sublinear term frequency and L2 normalized. It captures
+    word overlap rather than meaning, which is enough to bring back earlier
+    messages on the same topic without any model or network calls.
+
+    Any object with `dim` and `embed(texts) -> float32 array (len(texts), dim)`
+    can be used instead.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term, count in collections.Counter(tokenize(text or '')).items():
+                digest = zlib.crc32(term.encode())
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                vectors[row, digest % self.dim] += sign * (1 + math.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class _ChatMatrix:
+    """
+    Embeddings of one chat: <name>.<dim>.f32 holds float32 rows, <name>.<dim>.seq
+    holds int64 sequence numbers of the messages they came from. Both files are
+    only ever appended to and read through memory maps. Writers take a flock on
+    <name>.<dim>.lock, so replicas sharing the directory do not interleave rows.
+    """
+
+    def __init__(self, directory: pathlib.Path, name: str, dim: int):
+        self.dim = dim
+        self.vectors_path = directory / f'{name}.{dim}.f32'
+        self.seqs_path = directory / f'{name}.{dim}.seq'
+        self.lock_path = directory / f'{name}.{dim}.lock'
+        self._rows = 0
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._seqs = np.zeros(0, dtype=np.int64)
+
+    def _sizes(self) -> tuple[int, int]:
+        def size(path):
+            try:
+                return path.stat().st_size
+            except FileNotFoundError:
+                return 0
+
+        return size(self.vectors_path), size(self.seqs_path)
+
+    def _rows_on_disk(self) -> tuple[int, int]:
+        vectors_size, seqs_size = self._sizes()
+        return vectors_size // (4 * self.dim), seqs_size // 8
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self.lock_path.open('ab') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def append(self, seqs: list[int], vectors: np.ndarray):
+        with self._locked():
+            vectors_size, seqs_size = self._sizes()
+            rows = min(vectors_size // (4 * self.dim), seqs_size // 8)
+            if vectors_size != rows * 4 * self.dim or seqs_size != rows * 8:
+                # an earlier append was interrupted halfway, drop partial rows
+                # so that new ones are not read at a shifted offset
+                os.truncate(self.vectors_path, rows * 4 * self.dim)
+                os.truncate(self.seqs_path, rows * 8)
+            with self.vectors_path.open('ab') as fp:
+                fp.write(vectors.astype(np.float32, copy=False).tobytes())
+            with self.seqs_path.open('ab') as fp:
+                fp.write(np.asarray(seqs, dtype=np.int64).tobytes())
+
+    def load(self) -> tuple[np.ndarray, np.ndarray]:
+        rows = min(self._rows_on_disk())
+        if rows != self._rows:
+            if rows == 0:
+                self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+                self._seqs = np.zeros(0, dtype=np.int64)
+            else:
+                self._vectors = np.memmap(
+                    self.vectors_path,
+                    dtype=np.float32,
+                    mode='r',
+                    shape=(rows, self.dim),
+                )
+                self._seqs = np.memmap(
+                    self.seqs_path, dtype=np.int64, mode='r', shape=(rows,)
+                )
+            self._rows = rows
+        return self._vectors, self._seqs
+
+    def drop(self):
+        with self._locked():
+            self.vectors_path.unlink(missing_ok=True)
+            self.seqs_path.unlink(missing_ok=True)
+        self.load()
+
+
+class RetrievalMemory:
+    """
+    Similarity search over chat history.
+
+    Every saved message is embedded once and appended to its chat's matrix.
+    Lookups embed the query and score it against all rows with a single
+    matrix-vector product: a few milliseconds for a chat with tens of
+    thousands of messages.
+    """
+
+    def __init__(
+        self,
+        directory,
+        embedder: HashingEmbedder | None = None,
+        top_k: int = 3,
+        min_score: float = 0.3,
+    ):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.embedder = embedder or HashingEmbedder()
+        self.top_k = top_k
+        self.min_score = min_score
+        self._matrices: dict[str, _ChatMatrix] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, settings: dict) -> RetrievalMemory:
+        return cls(
+            settings['path'],
+            embedder=HashingEmbedder(settings.get('dim', 512)),
+            top_k=settings.get('top_k', 3),
+            min_score=settings.get('min_score', 0.3),
+        )
+
+    def _matrix(self, tag: str) -> _ChatMatrix:
+        with self._lock:
+            matrix = self._matrices.get(tag)
+            if matrix is None:
+                name = tag.split(':history:', 1)[-1].replace(':', '_')
+                matrix = _ChatMatrix(self.directory, name, self.embedder.dim)
+                self._matrices[tag] = matrix
+            return matrix
+
+    def index_many(self, items: list[tuple[str, int, str]]):
+        """items are (history key, sequence number, text)"""
+        per_chat = collections.defaultdict(list)
+        for tag, seq, text in items:
+            if text:
+                per_chat[tag].append((seq, text))
+        for tag, rows in per_chat.items():
+            seqs = [seq for seq, _ in rows]
+            vectors = self.embedder.embed([text for _, text in rows])
+            self._matrix(tag).append(seqs, vectors)
+        metrics.inc('memory.indexed', sum(map(len, per_chat.values())))
+
+    def drop(self, tag: str):
+        self._matrix(tag).drop()
+
+    def search(
+        self, tag: str, text: str, k: int | None = None
+    ) -> list[tuple[int, float]]:
+        """(sequence number, cosine similarity) of the closest messages, best first"""
+        k = k or self.top_k
+        vectors, seqs = self._matrix(tag).load()
+        query = self.embedder.embed([text])[0]
+        if len(seqs) == 0 or not query.any():
+            return []
+        scores = vectors @ query
+        if k < len(scores):
+            best = np.argpartition(scores, -k)[-k:]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(scores[best])[::-1]]
+        return [
+            (int(seqs[i]), float(scores[i]))
+            for i in best
+            if scores[i] >= self.min_score
+        ]
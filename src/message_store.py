@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import os
@@ -18,6 +19,8 @@ class StoredChatMessage:
     from_full_name: str
     timestamp: int
     text: str
+    message_id: int | None = None
+    reply_to: int | None = None
 
     def serialize(self):
         return json.dumps(asdict(self), ensure_ascii=False)
@@ -33,6 +36,7 @@ class StoredChatMessage:
     @classmethod
     def from_tg_message(cls, message):
         from_user = message.from_user
+        reply_to = message.reply_to_message
 
         return cls(
             chat_name=message.chat.full_name,
@@ -40,12 +44,42 @@ class StoredChatMessage:
             from_full_name=from_user.full_name,
             timestamp=int(message.date.timestamp()),
             text=message.text,
+            message_id=message.message_id,
+            reply_to=reply_to.message_id if reply_to is not None else None,
         )
 
 
 class MessageStore:
+    SEEN_IDS_KEPT = 5000
+
+    SAVED_STREAM_MAXLEN = 100000
+
+    # KEYS: history list, timeline zset, seen message ids zset,
+    #       optionally a stream to announce saved messages on
+    # ARGV: serialized message, timestamp, message_id or '', SEEN_IDS_KEPT,
+    #       SAVED_STREAM_MAXLEN
+    # returns sequence number of the saved message or -1 for a duplicate
+    SAVE_SCRIPT = """
+    if ARGV[3] ~= '' then
+        if redis.call('ZADD', KEYS[3], 'NX', ARGV[3], ARGV[3]) == 0 then
+            return -1
+        end
+        redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -tonumber(ARGV[4]) - 1)
+    end
+    local seq = redis.call('LPUSH', KEYS[1], ARGV[1]) - 1
+    redis.call('ZADD', KEYS[2], ARGV[2], seq)
+    if KEYS[4] then
+        redis.call(
+            'XADD', KEYS[4], 'MAXLEN', '~', ARGV[5], '*',
+            'tag', KEYS[1], 'seq', seq, 'message', ARGV[1]
+        )
+    end
+    return seq
+    """
+
     def __init__(self, redis_url: str):
         self.redis_conn = redis.from_url(redis_url)
+        self._save_script = self.redis_conn.register_script(self.SAVE_SCRIPT)
         logger.info('Redis message store connected')
 
     @classmethod
@@ -53,10 +87,66 @@ class MessageStore:
         url = os.getenv('REDIS_URL')
         return cls(url)
 
-    def save(self, tag: str, message: StoredChatMessage):
+    # Messages are LPUSHed, so the oldest one sits at the right end of the list.
+    # Sequence number of a message is its position counting from that end,
+    # which is index -(seq + 1) for redis and never changes on LPUSH.
+    # Timeline is a sorted set of sequence numbers scored by message timestamp.
+    # Seen is a sorted set of the last SEEN_IDS_KEPT telegram message ids,
+    # so that redelivered updates are not saved twice.
+
+    @staticmethod
+    def timeline_key(tag: str) -> str:
+        return tag.replace(':history:', ':timeline:', 1)
+
+    @staticmethod
+    def seen_key(tag: str) -> str:
+        return tag.replace(':history:', ':seen:', 1)
+
+    def _save_args(
+        self, tag: str, message: StoredChatMessage, saved_stream: str | None = None
+    ):
+        keys = [tag, self.timeline_key(tag), self.seen_key(tag)]
+        if saved_stream is not None:
+            keys.append(saved_stream)
+        message_id = '' if message.message_id is None else message.message_id
+        args = [
+            message.serialize(),
+            message.timestamp,
+            message_id,
+            self.SEEN_IDS_KEPT,
+            self.SAVED_STREAM_MAXLEN,
+        ]
+        return keys, args
+
+    def save(self, tag: str, message: StoredChatMessage) -> int:
+        """Save message, return its sequence number or -1 if it was seen already"""
         # might need to have a deeper per-hour or per-day split
         # alternatively, just trim it to like 5000?
-        self.redis_conn.lpush(tag, message.serialize())
+        keys, args = self._save_args(tag, message)
+        return self._save_script(keys=keys, args=args)
+
+    def save_many(
+        self,
+        tagged_messages: list[tuple[str, StoredChatMessage]],
+        saved_stream: str | None = None,
+    ) -> list[int]:
+        """
+        Save messages in one round trip, return their sequence numbers (-1 for
+        duplicates). Each saved message is also added to `saved_stream`, in
+        the same script, so it is announced if and only if it was saved.
+        """
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for tag, message in tagged_messages:
+                keys, args = self._save_args(tag, message, saved_stream)
+                self._save_script(keys=keys, args=args, client=pipe)
+            return pipe.execute()
+
+    def fetch_by_seq(self, key: str, seqs: list[int]) -> list[StoredChatMessage]:
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for seq in seqs:
+                pipe.lindex(key, -(seq + 1))
+            messages = pipe.execute()
+        return [StoredChatMessage.deserialize(m) for m in messages if m is not None]
 
     def fetch_stats(self, keys_pattern: str) -> list[tuple[str, int]]:
         keys = self.redis_conn.keys(keys_pattern)
@@ -74,3 +164,52 @@ class MessageStore:
             return messages
 
         return list(map(StoredChatMessage.deserialize, messages))
+
+    def seq_range_between(
+        self, key: str, start_ts: int, end_ts: int
+    ) -> tuple[int, int] | None:
+        timeline = self.timeline_key(key)
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(timeline, start_ts, end_ts, start=0, num=1)
+            pipe.zrevrangebyscore(timeline, end_ts, start_ts, start=0, num=1)
+            first, last = pipe.execute()
+        if not first:
+            return None
+        return int(first[0]), int(last[0])
+
+    def fetch_messages_between(
+        self, key: str, start_ts: int, end_ts: int, raw: bool = False
+    ) -> list[StoredChatMessage] | list[bytes]:
+        """Messages with start_ts <= timestamp <= end_ts, newest first"""
+        seq_range = self.seq_range_between(key, start_ts, end_ts)
+        if seq_range is None:
+            return []
+        first, last = seq_range
+        messages = self.redis_conn.lrange(key, -(last + 1), -(first + 1))
+        if raw:
+            return messages
+
+        return list(map(StoredChatMessage.deserialize, messages))
+
+    def seq_range_last(self, key: str, limit: int) -> tuple[int, int] | None:
+        """Sequence numbers of the last `limit` messages (all of them for -1)"""
+        total = self.redis_conn.llen(key)
+        if total == 0:
+            return None
+        first = 0 if limit < 0 else max(0, total - limit)
+        return first, total - 1
+
+    async def iter_seq_range(
+        self, key: str, first: int, last: int, page_size: int = 500, raw: bool = False
+    ):
+        """
+        Yield messages with sequence numbers first..last, oldest first, reading
+        `page_size` messages per round trip. Only one page is held in memory.
+        """
+        for lo in range(first, last + 1, page_size):
+            hi = min(lo + page_size, last + 1) - 1
+            page = await asyncio.to_thread(
+                self.redis_conn.lrange, key, -(hi + 1), -(lo + 1)
+            )
+            for message in reversed(page):
+                yield message if raw else StoredChatMessage.deserialize(message)
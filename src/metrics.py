@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+import collections
+
+
+counters: collections.Counter[str] = collections.Counter()
+
+
+def inc(name: str, value: int = 1) -> None:
+    counters[name] += value
+
+
+def gauge(name: str, value: int) -> None:
+    counters[name] = value
+
+
+def render(prefix: str = '') -> str:
+    return '\n'.join(
+        f'{name}: {value}'
+        for name, value in sorted(counters.items())
+        if name.startswith(prefix)
+    )
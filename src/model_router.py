@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import logging
+import time
+from dataclasses import dataclass
+
+
+logger = logging.getLogger(__name__)
+
+
+TASK_CHAT = 'chat'
+TASK_TRANSLATION = 'translation'
+TASK_SUMMARY_CHUNK = 'summary_chunk'
+TASK_FINAL_SUMMARY = 'final_summary'
+TASKS = frozenset({TASK_CHAT, TASK_TRANSLATION, TASK_SUMMARY_CHUNK, TASK_FINAL_SUMMARY})
+
+
+@dataclass(frozen=True)
+class RoutingRule:
+    """
+    One [[routing]] entry of the config.
+
+    provider: requests to this provider are routed by the rule
+    models: candidate models, most preferred first
+    tasks: task types the rule applies to, any task if empty
+    min_tokens, max_tokens: prompt sizes the rule applies to
+    max_latency_ms: a model slower than that on average is skipped
+    """
+
+    provider: str
+    models: tuple[str, ...]
+    tasks: frozenset[str] = frozenset()
+    min_tokens: int = 0
+    max_tokens: int | None = None
+    max_latency_ms: int | None = None
+
+    @classmethod
+    def from_dict(cls, values: dict) -> RoutingRule:
+        rule = cls(
+            provider=values['provider'],
+            models=tuple(values['models']),
+            tasks=frozenset(values.get('tasks', ())),
+            min_tokens=values.get('min_tokens', 0),
+            max_tokens=values.get('max_tokens'),
+            max_latency_ms=values.get('max_latency_ms'),
+        )
+        if not rule.models:
+            raise ValueError(f'routing rule for {rule.provider} has no models')
+        if unknown := rule.tasks - TASKS:
+            raise ValueError(f'unknown routing tasks: {", ".join(sorted(unknown))}')
+        return rule
+
+    @property
+    def needs_tokens(self) -> bool:
+        return self.min_tokens > 0 or self.max_tokens is not None
+
+    def matches(self, provider: str, task: str, tokens: int | None) -> bool:
+        if provider != self.provider:
+            return False
+        if self.tasks and task not in self.tasks:
+            return False
+        if tokens is not None and tokens < self.min_tokens:
+            return False
+        if tokens is not None and self.max_tokens is not None:
+            return tokens <= self.max_tokens
+        return True
+
+
+@dataclass
+class ModelStats:
+    latency_ms: float = 0.0
+    error_rate: float = 0.0
+    calls: int = 0
+    updated_at: float = 0.0
+
+
+class ModelRouter:
+    """
+    Picks a model for every request from the [[routing]] rules of the config.
+
+    The first matching rule gives the candidate models. The first of them that
+    is healthy wins: its moving average error rate is below `max_error_rate`
+    and latency is within the rule's max_latency_ms. If none is healthy, the
+    least bad one is used. A model that has not been used for `probe_after`
+    seconds counts as healthy again, so it gets a chance to recover.
+    Without a matching rule the provider's model from [models] is used.
+    """
+
+    def __init__(
+        self,
+        count_tokens=None,
+        alpha: float = 0.2,
+        max_error_rate: float = 0.5,
+        probe_after: float = 60,
+    ):
+        self.count_tokens = count_tokens
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.probe_after = probe_after
+        self.stats: dict[tuple[str, str], ModelStats] = {}
+
+    def _tokens(self, messages) -> int:
+        return sum(self.count_tokens(text) for _, text in messages)
+
+    def pick(self, rules, provider: str, task: str, messages, default: str) -> str:
+        tokens = None
+        if self.count_tokens is not None and any(
+            rule.provider == provider and rule.needs_tokens for rule in rules
+        ):
+            tokens = self._tokens(messages)
+
+        for rule in rules:
+            if rule.matches(provider, task, tokens):
+                return self._pick_model(rule)
+        return default
+
+    def _pick_model(self, rule: RoutingRule) -> str:
+        for model in rule.models:
+            if self.healthy(rule, model):
+                return model
+        return min(rule.models, key=lambda model: self._badness(rule.provider, model))
+
+    def healthy(self, rule: RoutingRule, model: str) -> bool:
+        stats = self.stats.get((rule.provider, model))
+        if stats is None or time.monotonic() - stats.updated_at > self.probe_after:
+            return True
+        if stats.error_rate > self.max_error_rate:
+            return False
+        if rule.max_latency_ms is not None:
+            return stats.latency_ms <= rule.max_latency_ms
+        return True
+
+    def _badness(self, provider: str, model: str) -> tuple[float, float]:
+        stats = self.stats.get((provider, model), ModelStats())
+        return stats.error_rate, stats.latency_ms
+
+    def record(self, provider: str, model: str, latency_ms: int, success: bool):
+        stats = self.stats.setdefault((provider, model), ModelStats())
+        error = 0.0 if success else 1.0
+        if stats.calls == 0:
+            stats.latency_ms, stats.error_rate = float(latency_ms), error
+        else:
+            stats.latency_ms += self.alpha * (latency_ms - stats.latency_ms)
+            stats.error_rate += self.alpha * (error - stats.error_rate)
+        stats.calls += 1
+        stats.updated_at = time.monotonic()
+
+    def render(self) -> str:
+        return '\n'.join(
+            f'{provider}/{model}: {s.calls} calls, '
+            f'~{s.latency_ms:.0f}ms, {s.error_rate:.0%} errors'
+            for (provider, model), s in sorted(self.stats.items())
+        )
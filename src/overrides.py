@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import logging
+import uuid
+
+import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+class RuntimeOverrides:
+    """
+    Per-chat runtime overrides (prompt, provider) shared between bot instances.
+
+    Redis is the source of truth: one hash per chat. Every instance keeps a local
+    copy of all hashes, so reads never leave the process. Writers publish chat id
+    on the invalidation channel, and every subscriber re-reads that single hash.
+    """
+
+    FIELDS = ('prompt', 'provider')
+
+    def __init__(self, redis_conn: redis.Redis, namespace: str):
+        self.redis_conn = redis_conn
+        self.key_prefix = f'matvey-3000:overrides:{namespace}'
+        self.channel = f'{self.key_prefix}:invalidate'
+        self.instance_id = uuid.uuid4().hex
+        self._cache: dict[int, dict[str, str]] = {}
+        self._listeners = []
+
+    def key(self, chat_id: int) -> str:
+        return f'{self.key_prefix}:chat:{chat_id}'
+
+    def __getitem__(self, chat_id: int) -> dict[str, str]:
+        return self._cache.get(chat_id, {})
+
+    def items(self):
+        return list(self._cache.items())
+
+    def add_listener(self, callback):
+        """callback(chat_id, fields) is called whenever a chat's overrides change"""
+        self._listeners.append(callback)
+
+    def load_all(self) -> int:
+        for key in self.redis_conn.scan_iter(match=self.key(chat_id='*')):
+            chat_id = int(key.decode().rsplit(':', 1)[-1])
+            self.refresh(chat_id)
+        logger.info('Loaded runtime overrides for %d chats', len(self._cache))
+        return len(self._cache)
+
+    def refresh(self, chat_id: int):
+        raw = self.redis_conn.hgetall(self.key(chat_id))
+        fields = {
+            k.decode(): v.decode() for k, v in raw.items() if k.decode() in self.FIELDS
+        }
+        if fields:
+            self._cache[chat_id] = fields
+        else:
+            self._cache.pop(chat_id, None)
+        for callback in self._listeners:
+            callback(chat_id, fields)
+
+    def set(self, chat_id: int, **fields) -> bool:
+        unknown = set(fields) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f'Unknown override fields: {", ".join(sorted(unknown))}')
+        try:
+            with self.redis_conn.pipeline() as pipe:
+                pipe.hset(self.key(chat_id), mapping=fields)
+                pipe.publish(self.channel, f'{self.instance_id}:{chat_id}')
+                pipe.execute()
+        except redis.RedisError:
+            logger.exception('Failed to store overrides for chat %s', chat_id)
+            return False
+        self._cache.setdefault(chat_id, {}).update(fields)
+        return True
+
+    def _on_invalidate(self, message):
+        instance_id, _, chat_id = message['data'].decode().partition(':')
+        if instance_id == self.instance_id:
+            # our own write, local cache is already up to date
+            return
+        try:
+            self.refresh(int(chat_id))
+        except redis.RedisError:
+            logger.exception('Failed to refresh overrides for chat %s', chat_id)
+
+    def start(self, pubsub: redis.client.PubSub):
+        """
+        Listen for invalidations on `pubsub`. Bots hosted in one process share
+        it, whoever owns it runs it.
+        """
+        pubsub.subscribe(**{self.channel: self._on_invalidate})
+        logger.info('Listening for override invalidations on %s', self.channel)
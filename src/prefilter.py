@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import random
+
+from aiogram import BaseMiddleware, types
+
+import metrics
+from config import Config
+from ingest import Ingest
+from message_store import StoredChatMessage
+
+
+class PreFilterMiddleware(BaseMiddleware):
+    """
+    Outer middleware that classifies every incoming message exactly once.
+
+    Most group traffic is not addressed to the bot, so it is only queued for
+    history (when enabled for the chat) and never reaches the handlers.
+    Verdict is passed to handlers as `relevance`, drop reasons are counted in
+    `prefilter.*` metrics.
+    """
+
+    PASS = frozenset({'command', 'private', 'mention', 'reply_to_bot', 'random_reply'})
+
+    def __init__(self, config: Config, ingest: Ingest, random_reply_chance=0.05):
+        self.config = config
+        self.ingest = ingest
+        self.random_reply_chance = random_reply_chance
+
+    async def __call__(self, handler, event: types.Message, data):
+        relevance = self.classify(event, bot_id=data['bot'].id)
+        metrics.inc(f'prefilter.{relevance}')
+
+        if relevance != 'command' and event.text:
+            chat_config = self.config.configs.get(event.chat.id)
+            if chat_config is not None and chat_config.save_messages:
+                self.ingest.submit(
+                    self.config.history_key(event.chat.id),
+                    StoredChatMessage.from_tg_message(event),
+                )
+
+        if relevance not in self.PASS:
+            return None
+        data['relevance'] = relevance
+        return await handler(event, data)
+
+    def classify(self, message: types.Message, bot_id: int) -> str:
+        text = message.text or message.caption
+        if not text:
+            return 'no_text'
+        entities = message.entities or message.caption_entities or []
+        if any(e.type == 'bot_command' and e.offset == 0 for e in entities):
+            return 'command'
+        if message.chat.id not in self.config.allowed_chat_id:
+            return 'not_allowed'
+        if not message.text:
+            return 'no_text'
+        if len(text.split(maxsplit=1)) < 2:
+            # single words are never worth a reply
+            return 'single_word'
+        if message.chat.type == 'private':
+            return 'private'
+
+        reply_to = message.reply_to_message
+        if reply_to is not None and reply_to.from_user is not None:
+            if reply_to.from_user.id == bot_id:
+                return 'reply_to_bot'
+
+        me = self.config.me_strip_lower
+        for entity in entities:
+            if entity.type == 'mention':
+                if entity.extract_from(text).lstrip('@').lower() == me:
+                    return 'mention'
+            elif entity.type == 'text_mention' and entity.user is not None:
+                if entity.user.id == bot_id:
+                    return 'mention'
+
+        if reply_to is not None:
+            if random.random() < self.random_reply_chance:
+                return 'random_reply'
+            return 'reply_to_other'
+        return 'not_addressed'
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import re
+
+import redis
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+STOPWORDS = frozenset(
+    '''
+    и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по
+    только ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если
+    уже или ни быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей
+    может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз
+    тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом
+    один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец
+    два об другой хоть после над больше тот через эти нас про всего них какая много
+    разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой
+    им более всегда конечно всю между это
+    a an and are as at be but by for from has have he her his i in is it its me my
+    not of on or our she so that the their them they this to was we were what when
+    which who will with you your
+    '''.split()
+)
+
+RU_SUFFIXES = sorted(
+    '''
+    иями ями ами ией иях ого его ому ему ыми ими ая яя ое ее ие ые ой ей ий ый ую юю
+    ом ем ах ях ам ям ов ев ия ья ью ию ть ться тся ешь ете ишь ите ет ит ут ют ат ят
+    ла ло ли ал ял ил ыл ел а я о е ы и у ю ь й
+    '''.split(),
+    key=len,
+    reverse=True,
+)
+EN_SUFFIXES = ('ing', 'edly', 'ed', 'ies', 'es', 'ly', 's')
+
+
+def _stem(token: str) -> str:
+    if token.isascii():
+        suffixes, min_stem = EN_SUFFIXES, 3
+    else:
+        suffixes, min_stem = RU_SUFFIXES, 3
+    for suffix in suffixes:
+        if token.endswith(suffix) and len(token) - len(suffix) >= min_stem:
+            return token[: -len(suffix)]
+    return token
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split text into normalized search terms.
+
+    Lowercases, folds ё into е, drops stopwords and one-letter tokens and
+    strips the most common Russian and English endings, so that
+    "котами" and "кот", "cats" and "cat" end up as the same term.
+    """
+    text = text.lower().replace('ё', 'е')
+    terms = []
+    for token in TOKEN_RE.findall(text):
+        if len(token) < 2 or token in STOPWORDS:
+            continue
+        terms.append(_stem(token))
+    return terms
+
+
+class SearchIndex:
+    """
+    Inverted index over chat history, kept in redis.
+
+    For every history key and term there is a sorted set of message sequence
+    numbers (see MessageStore.save), scored by the same number, so the newest
+    matches come first and multi-term queries are a single ZINTERSTORE.
+    """
+
+    def __init__(self, redis_conn: redis.Redis):
+        self.redis_conn = redis_conn
+
+    @staticmethod
+    def term_key(history_key: str, term: str) -> str:
+        return f'{history_key.replace(":history:", ":search:", 1)}:{term}'
+
+    def index(self, pipe, history_key: str, seq: int, text: str):
+        for term in set(tokenize(text or '')):
+            pipe.zadd(self.term_key(history_key, term), {seq: seq})
+
+    def index_many(self, items: list[tuple[str, int, str]]):
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for history_key, seq, text in items:
+                self.index(pipe, history_key, seq, text)
+            pipe.execute()
+
+    def drop(self, history_key: str) -> int:
+        pattern = self.term_key(history_key, '*')
+        dropped = 0
+        batch = []
+        for key in self.redis_conn.scan_iter(match=pattern, count=1000):
+            batch.append(key)
+            if len(batch) == 1000:
+                dropped += self.redis_conn.unlink(*batch)
+                batch = []
+        if batch:
+            dropped += self.redis_conn.unlink(*batch)
+        return dropped
+
+    def search(self, history_key: str, query: str, limit: int = 10) -> list[int]:
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        keys = [self.term_key(history_key, term) for term in terms]
+        if len(keys) == 1:
+            found = self.redis_conn.zrevrange(keys[0], 0, limit - 1)
+        else:
+            tmp_key = self.term_key(history_key, f'_query:{"+".join(terms)}')
+            with self.redis_conn.pipeline() as pipe:
+                pipe.zinterstore(tmp_key, keys, aggregate='MAX')
+                pipe.zrevrange(tmp_key, 0, limit - 1)
+                pipe.delete(tmp_key)
+                _, found, _ = pipe.execute()
+        return [int(seq) for seq in found]
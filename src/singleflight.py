@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+
+import redis
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Runs identical concurrent requests only once.
+
+    Within a process, callers with the same key await the first caller's
+    future. Across processes, the first caller takes a redis lock, computes,
+    stores the serialized result for `result_ttl` seconds and announces it on
+    the done channel. Other processes wait for that announcement (or poll),
+    and take over if the lock disappears without a result.
+    """
+
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        namespace: str,
+        lock_ttl: int = 600,
+        result_ttl: int = 60,
+        poll_interval: float = 1.0,
+    ):
+        self.redis_conn = redis_conn
+        self.key_prefix = f'matvey-3000:singleflight:{namespace}'
+        self.channel = f'{self.key_prefix}:done'
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._release = redis_conn.register_script(self.RELEASE_SCRIPT)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._loop = None
+        self._pubsub_thread = None
+
+    @staticmethod
+    def make_key(chat_id, command: str, args: str | None, window: int) -> str:
+        normalized = ' '.join((args or '').lower().split())
+        digest = hashlib.sha1(normalized.encode()).hexdigest()
+        return f'{chat_id}:{command}:{digest}:{int(time.time() // window)}'
+
+    async def do(self, key: str, fn, dumps, loads):
+        """
+        Return result of `await fn()` shared with everyone asking for the same
+        key at the same time. `dumps`/`loads` convert the result to and from str
+        """
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            metrics.inc('singleflight.joined_local')
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._do_shared(key, fn, dumps, loads)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the exception is re-raised to us, make sure nobody else logs it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+    def _lock_key(self, key):
+        return f'{self.key_prefix}:lock:{key}'
+
+    def _result_key(self, key):
+        return f'{self.key_prefix}:result:{key}'
+
+    async def _do_shared(self, key, fn, dumps, loads):
+        token = uuid.uuid4().hex
+        while True:
+            raw = self.redis_conn.get(self._result_key(key))
+            if raw is not None:
+                metrics.inc('singleflight.joined_remote')
+                return loads(raw.decode())
+
+            lock_key = self._lock_key(key)
+            if self.redis_conn.set(lock_key, token, nx=True, ex=self.lock_ttl):
+                break
+
+            raw = await self._wait_for_result(key)
+            if raw is not None:
+                metrics.inc('singleflight.joined_remote')
+                return loads(raw.decode())
+            # lock holder is gone without leaving a result, try to take over
+
+        metrics.inc('singleflight.leader')
+        try:
+            result = await fn()
+            with self.redis_conn.pipeline() as pipe:
+                pipe.set(self._result_key(key), dumps(result), ex=self.result_ttl)
+                pipe.publish(self.channel, key)
+                pipe.execute()
+            return result
+        finally:
+            self._release(keys=[self._lock_key(key)], args=[token])
+
+    async def _wait_for_result(self, key) -> bytes | None:
+        wakeup = self._wakeups.setdefault(key, asyncio.Event())
+        try:
+            deadline = time.monotonic() + self.lock_ttl
+            while time.monotonic() < deadline:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+                except TimeoutError:
+                    pass
+                wakeup.clear()
+                raw = self.redis_conn.get(self._result_key(key))
+                if raw is not None:
+                    return raw
+                if not self.redis_conn.exists(self._lock_key(key)):
+                    return None
+            return None
+        finally:
+            self._wakeups.pop(key, None)
+
+    def _on_done(self, message):
+        key = message['data'].decode()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake, key)
+
+    def _wake(self, key):
+        wakeup = self._wakeups.get(key)
+        if wakeup is not None:
+            wakeup.set()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self._on_done})
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
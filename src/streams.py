@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass
+
+import redis
+
+import metrics
+from message_store import StoredChatMessage
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StreamEntry:
+    id: bytes
+    tag: str
+    message: StoredChatMessage
+    seq: int | None = None
+
+    @classmethod
+    def from_fields(cls, entry_id: bytes, fields: dict[bytes, bytes]) -> StreamEntry:
+        seq = fields.get(b'seq')
+        return cls(
+            id=entry_id,
+            tag=fields[b'tag'].decode(),
+            message=StoredChatMessage.deserialize(fields[b'message']),
+            seq=None if seq is None else int(seq),
+        )
+
+
+class StreamConsumer:
+    """
+    Base class for stream consumers. `group` names the consumer group, so
+    every consumer sees every entry once no matter how many bots are running.
+    handle() runs in a worker thread and gets a batch of entries; if it
+    raises, the whole batch is retried later.
+    """
+
+    group: str
+
+    def handle(self, entries: list[StreamEntry]) -> None:
+        raise NotImplementedError
+
+
+class StreamWorker:
+    """
+    Feeds entries of a redis stream to one consumer group.
+
+    New entries are read with XREADGROUP and acknowledged once handle()
+    returns. Entries left unacknowledged for `claim_idle_ms`, by a failed
+    batch or a crashed process, are claimed again and retried one by one.
+    An entry delivered `max_deliveries` times goes to the <stream>:dead
+    stream instead. Pending and lag counts of the group are reported to
+    metrics every `lag_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        stream: str,
+        consumer: StreamConsumer,
+        batch_size: int = 100,
+        block_ms: int = 1000,
+        claim_idle_ms: int = 60000,
+        max_deliveries: int = 5,
+        lag_interval: float = 30,
+    ):
+        self.redis_conn = redis_conn
+        self.stream = stream
+        self.consumer = consumer
+        self.group = consumer.group
+        self.name = f'{socket.gethostname()}-{os.getpid()}'
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.lag_interval = lag_interval
+        self._next_claim = 0.0
+        self._next_lag_report = 0.0
+        # XREADGROUP blocks, keep it off the default executor used by handlers
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f'stream-{self.group}'
+        )
+
+    @property
+    def dead_stream(self) -> str:
+        return f'{self.stream}:dead'
+
+    def ensure_group(self):
+        try:
+            self.redis_conn.xgroup_create(
+                self.stream, self.group, id='0', mkstream=True
+            )
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def step(self) -> int:
+        """Handle one batch, return how many entries were acknowledged"""
+        now = time.monotonic()
+        if now >= self._next_lag_report:
+            self._next_lag_report = now + self.lag_interval
+            self.report_lag()
+        if now >= self._next_claim:
+            self._next_claim = now + self.claim_idle_ms / 2000
+            retried = self._claim_stale()
+            if retried:
+                return sum(self._handle([entry]) for entry in retried)
+
+        response = self.redis_conn.xreadgroup(
+            self.group,
+            self.name,
+            {self.stream: '>'},
+            count=self.batch_size,
+            block=self.block_ms,
+        )
+        entries = [entry for _, stream_entries in response for entry in stream_entries]
+        return self._handle(entries) if entries else 0
+
+    def _handle(self, raw_entries) -> int:
+        ids = [entry_id for entry_id, _ in raw_entries]
+        try:
+            entries = [StreamEntry.from_fields(*entry) for entry in raw_entries]
+            self.consumer.handle(entries)
+        except Exception:
+            metrics.inc(f'stream.{self.group}.failed', len(ids))
+            logger.exception('%s failed to handle %d entries', self.group, len(ids))
+            return 0
+        self.redis_conn.xack(self.stream, self.group, *ids)
+        metrics.inc(f'stream.{self.group}.handled', len(ids))
+        return len(ids)
+
+    def _claim_stale(self) -> list:
+        pending = self.redis_conn.xpending_range(
+            self.stream,
+            self.group,
+            min='-',
+            max='+',
+            count=self.batch_size,
+            idle=self.claim_idle_ms,
+        )
+        if not pending:
+            return []
+
+        dead, retry = [], []
+        for entry in pending:
+            if entry['times_delivered'] >= self.max_deliveries:
+                dead.append(entry['message_id'])
+            else:
+                retry.append(entry['message_id'])
+        if dead:
+            self._bury(dead)
+        if not retry:
+            return []
+        metrics.inc(f'stream.{self.group}.retried', len(retry))
+        claimed = self.redis_conn.xclaim(
+            self.stream, self.group, self.name, self.claim_idle_ms, retry
+        )
+        # entries trimmed from the stream in the meantime come back empty
+        return [(entry_id, fields) for entry_id, fields in claimed if fields]
+
+    def _bury(self, ids):
+        entries = self.redis_conn.xclaim(
+            self.stream, self.group, self.name, self.claim_idle_ms, ids
+        )
+        with self.redis_conn.pipeline() as pipe:
+            for entry_id, fields in entries:
+                if not fields:
+                    continue
+                pipe.xadd(
+                    self.dead_stream,
+                    {**fields, b'group': self.group, b'origin': entry_id},
+                    maxlen=10000,
+                    approximate=True,
+                )
+            pipe.xack(self.stream, self.group, *ids)
+            pipe.execute()
+        metrics.inc(f'stream.{self.group}.dead', len(ids))
+        logger.error(
+            '%s gave up on %d entries, moved them to %s',
+            self.group,
+            len(ids),
+            self.dead_stream,
+        )
+
+    def report_lag(self):
+        for group in self.redis_conn.xinfo_groups(self.stream):
+            if group['name'].decode() != self.group:
+                continue
+            metrics.gauge(f'stream.{self.group}.pending', group['pending'])
+            if group.get('lag') is not None:
+                metrics.gauge(f'stream.{self.group}.lag', group['lag'])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.ensure_group)
+        logger.info('Consuming %s as %s/%s', self.stream, self.group, self.name)
+        while True:
+            try:
+                await loop.run_in_executor(self._executor, self.step)
+            except redis.RedisError:
+                logger.exception('%s lost connection to redis', self.group)
+                await asyncio.sleep(1)
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import functools
+import json
+import re
+import time
+from dataclasses import dataclass
+
+import tiktoken
+
+from model_router import TASK_FINAL_SUMMARY, TASK_SUMMARY_CHUNK
+
+
+DURATION_RE = re.compile(r'^(\d+)\s*([mhdw])$')
+DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+
+MAX_CHUNK_TOKENS = 16385
+
+CHUNK_PROMPT = """
+You are a helpful assistant who is a pinnacle of retelling craft.
+You have to retell text in no more than 25 sentences using Russian language only.
+The text is written by other chat members. You need to retell in short their most emotionally charged and interesting
+phrases by mentioning their originators and then retelling up their points. You can seldom mix up or exaggerate things
+purely for comic purposes. You never lose a chronology of events, and try to mention each participant's important input,
+while balancing the amount of attention each participant gets. Texts produced by chatbots (such as Matthew3000,
+Ben the Snarky Shark, Summary Bot, User of the Day) have lower priority always.
+""".strip()  # noqa
+
+FINAL_PROMPT = """
+You are a modest and helpful assistant who is a pinnacle of retelling craft.
+You have to retell text in no more than 25 sentences using Russian language only.
+The text is written by other chat members. You need to retell in short their most emotionally charged and interesting
+phrases by mentioning their originators and then retelling up their points. You can seldom mix up or exaggerate things
+purely for comic purposes. You never lose a chronology of events, and try to mention each participant's important input,
+while balancing the amount of attention each participant gets. Texts produced by chatbots (such as Matthew3000,
+Ben the Snarky Shark, Summary Bot, User of the Day) have lower priority always.
+After you make a summary, highlight three most outstanding facts or points from it in a separate paragraph.
+""".strip()  # noqa
+
+
+@dataclass(frozen=True)
+class SummaryWindow:
+    """Either last `limit` messages (-1 for all of them) or everything since `since`"""
+
+    limit: int = -1
+    since: int | None = None
+
+
+def parse_window(args: str | None, now: float | None = None) -> SummaryWindow:
+    """
+    Parse /sum arguments: nothing, message count (500), duration (30m, 6h, 2d, 1w)
+    or a start date (2024-03-08, 08.03.2024, 08.03). Raises ValueError otherwise.
+    """
+    now = time.time() if now is None else now
+    args = (args or '').strip().lower()
+    if not args:
+        return SummaryWindow()
+    if args.isdigit():
+        if int(args) < 1:
+            raise ValueError(f'need at least one message: {args!r}')
+        return SummaryWindow(limit=int(args))
+
+    if match := DURATION_RE.match(args):
+        amount, unit = match.groups()
+        return SummaryWindow(since=int(now - int(amount) * DURATION_UNITS[unit]))
+
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime(args, date_format)
+        except ValueError:
+            continue
+        return SummaryWindow(since=int(date.timestamp()))
+
+    # day and month without a year mean the latest such date that has passed,
+    # parsed together with the year so that 29.02 works in leap years
+    today = datetime.datetime.fromtimestamp(now)
+    for year in (today.year, today.year - 1):
+        try:
+            date = datetime.datetime.strptime(f'{args}.{year}', '%d.%m.%Y')
+        except ValueError:
+            continue
+        if date <= today:
+            return SummaryWindow(since=int(date.timestamp()))
+
+    raise ValueError(f'cannot parse summary window: {args!r}')
+
+
+@functools.cache
+def encoding_for_model(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # not an openai model, this is close enough for chunking
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def token_counter(model: str):
+    # the encoding is loaded on first use, it may need to be downloaded
+    def count_tokens(text: str) -> int:
+        return len(encoding_for_model(model).encode(text))
+
+    return count_tokens
+
+
+async def decode_texts(raw_messages):
+    """raw serialized StoredChatMessage -> its text, skipping empty ones"""
+    async for raw in raw_messages:
+        text = json.loads(raw).get('text')
+        if text:
+            yield text
+
+
+async def build_chunks(texts, count_tokens, max_tokens: int = MAX_CHUNK_TOKENS):
+    """
+    Glue consecutive texts into chunks of less than max_tokens tokens.
+    Every text is tokenized exactly once, only the current chunk is kept.
+    """
+    current, current_tokens = [], 0
+    async for text in texts:
+        tokens = count_tokens(text) + 1  # +1 for the line break
+        if current and current_tokens + tokens >= max_tokens:
+            yield '\n'.join(current).strip()
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        yield '\n'.join(current).strip()
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+async def condense(
+    texts,
+    generate,
+    count_tokens,
+    on_progress=None,
+    max_tokens: int = MAX_CHUNK_TOKENS,
+    pause: float = 0.5,
+    entity: str = 'чанк',
+) -> list[str]:
+    """
+    Map step: glue an async stream of texts into chunks and retell each one.
+    on_progress(entity, number) is awaited before every chunk.
+    """
+    summaries = []
+    async for chunk in build_chunks(texts, count_tokens, max_tokens):
+        if on_progress is not None:
+            await on_progress(entity, len(summaries) + 1)
+        reply = await generate(
+            [('system', CHUNK_PROMPT), ('user', chunk)], TASK_SUMMARY_CHUNK
+        )
+        summaries.append(reply.text)
+        await asyncio.sleep(pause)
+    return summaries
+
+
+async def reduce(
+    summaries: list[str],
+    generate,
+    count_tokens,
+    on_progress=None,
+    max_tokens: int = MAX_CHUNK_TOKENS,
+    pause: float = 0.5,
+):
+    """
+    Reduce step: condense partial summaries again until they fit into one
+    final call, then make the final summary out of them.
+    """
+    budget = max_tokens - count_tokens(FINAL_PROMPT)
+    final_summary = '\n'.join(summaries)
+    while len(summaries) > 1 and count_tokens(final_summary) > budget:
+        summaries = await condense(
+            _aiter(summaries),
+            generate,
+            count_tokens,
+            on_progress,
+            max_tokens,
+            pause,
+            entity='предсаммари',
+        )
+        final_summary = '\n'.join(summaries)
+
+    return await generate(
+        [('system', FINAL_PROMPT), ('user', final_summary)], TASK_FINAL_SUMMARY
+    )
+
+
+async def summarize(
+    texts,
+    generate,
+    count_tokens,
+    on_progress=None,
+    max_tokens: int = MAX_CHUNK_TOKENS,
+    pause: float = 0.5,
+):
+    """
+    Map-reduce summary of an async stream of texts.
+
+    generate(messages, task) -> TextResponse is called for every chunk, then
+    again over the partial summaries until they fit into one final call.
+    """
+    summaries = await condense(
+        texts, generate, count_tokens, on_progress, max_tokens, pause
+    )
+    return await reduce(
+        summaries, generate, count_tokens, on_progress, max_tokens, pause
+    )
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.methods import DeleteMessage, SendChatAction
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+_coalesce_edits = contextvars.ContextVar('coalesce_edits', default=True)
+
+
+@contextlib.contextmanager
+def awaited_edits():
+    """
+    Edits made inside the block are not coalesced: they replace the pending
+    edit of the same message and are sent before the call returns, so the
+    caller sees failures. Meant for the final text of a message.
+    """
+    token = _coalesce_edits.set(False)
+    try:
+        yield
+    finally:
+        _coalesce_edits.reset(token)
+
+
+class RateLimiter:
+    """
+    GCRA flavour of a token bucket: `rate` requests per second with bursts of
+    up to `burst` requests. reserve() books the next slot and returns how long
+    to wait for it, so concurrent callers queue up fairly without locks.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1 / rate
+        self.burst = burst
+        self.tat = 0.0  # theoretical arrival time of the next request
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        tat = max(self.tat, now)
+        self.tat = tat + self.interval
+        return max(0.0, tat - (self.burst - 1) * self.interval - now)
+
+    def pause(self, seconds: float):
+        self.tat = max(self.tat, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        return self.tat < time.monotonic()
+
+
+class TelegramScheduler(BaseRequestMiddleware):
+    """
+    Session middleware that shapes all outgoing Bot API calls.
+
+    - chat actions are valid for 5 seconds, repeats within that window are
+      answered locally
+    - edits of the same message are coalesced, only the latest text is sent;
+      edits are sent in the background and the caller gets True right away,
+      unless they are made inside awaited_edits()
+    - messages and edits are throttled per chat and globally
+    - on RetryAfter the call is retried after the delay Telegram asked for
+
+    Limits are per bot, so one session can be shared by several bots.
+    """
+
+    CHAT_ACTION_TTL = 5.0
+    MAX_TRACKED_CHATS = 10000
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        private_chat_rate: float = 1,
+        group_chat_rate: float = 20 / 60,
+        chat_burst: int = 3,
+        max_retries: int = 3,
+    ):
+        self.global_rate = global_rate
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._global_limiters: dict[int | None, RateLimiter] = {}
+        self._chat_limiters: dict[tuple, RateLimiter] = {}
+        self._chat_actions: dict[tuple, dict[tuple, float]] = {}
+        self._pending_edits: dict[tuple, dict[type, object]] = {}
+        self._background: set[asyncio.Task] = set()
+
+    @staticmethod
+    def _chat_key(bot, chat_id) -> tuple:
+        return (getattr(bot, 'id', None), chat_id)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        chat = self._chat_key(bot, chat_id)
+
+        if isinstance(method, SendChatAction):
+            return await self._chat_action(make_request, bot, method)
+
+        if isinstance(method, DeleteMessage):
+            self._pending_edits.pop((*chat, method.message_id), None)
+            return await self._send(make_request, bot, method)
+
+        name = type(method).__name__
+        if name.startswith('Edit') and getattr(method, 'message_id', None):
+            if _coalesce_edits.get():
+                return self._coalesce_edit(make_request, bot, method)
+            self._drop_pending_edit(bot, method)
+            await self._wait_turn(chat)
+
+        if name.startswith(('Send', 'Copy', 'Forward')):
+            # a new message resets chat action display on the client side
+            self._forget_chat_actions(chat)
+            await self._wait_turn(chat)
+
+        return await self._send(make_request, bot, method)
+
+    def _global_limiter(self, bot_id) -> RateLimiter:
+        limiter = self._global_limiters.get(bot_id)
+        if limiter is None:
+            limiter = RateLimiter(self.global_rate, burst=int(self.global_rate))
+            self._global_limiters[bot_id] = limiter
+        return limiter
+
+    def _chat_limiter(self, chat) -> RateLimiter:
+        limiter = self._chat_limiters.get(chat)
+        if limiter is None:
+            if len(self._chat_limiters) >= self.MAX_TRACKED_CHATS:
+                self._chat_limiters = {
+                    k: v for k, v in self._chat_limiters.items() if not v.idle()
+                }
+            _, chat_id = chat
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            rate = self.private_chat_rate if is_private else self.group_chat_rate
+            limiter = RateLimiter(rate, burst=self.chat_burst)
+            self._chat_limiters[chat] = limiter
+        return limiter
+
+    async def _wait_turn(self, chat):
+        bot_id, chat_id = chat
+        delay = self._chat_limiter(chat).reserve() if chat_id is not None else 0
+        delay = max(delay, self._global_limiter(bot_id).reserve())
+        if delay > 0:
+            metrics.inc('telegram.throttled')
+            await asyncio.sleep(delay)
+
+    async def _send(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.inc('telegram.retry_after')
+                logger.warning(
+                    'Flood control on %s in chat %s, retrying in %ss',
+                    type(method).__name__,
+                    chat_id,
+                    e.retry_after,
+                )
+                chat = self._chat_key(bot, chat_id)
+                if chat_id is not None:
+                    self._chat_limiter(chat).pause(e.retry_after)
+                else:
+                    self._global_limiter(chat[0]).pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+    async def _chat_action(self, make_request, bot, method: SendChatAction):
+        chat = self._chat_key(bot, method.chat_id)
+        key = (method.message_thread_id, method.action)
+        now = time.monotonic()
+        if self._chat_actions.get(chat, {}).get(key, 0) > now:
+            metrics.inc('telegram.chat_action_deduped')
+            return True
+        if len(self._chat_actions) >= self.MAX_TRACKED_CHATS:
+            self._chat_actions = {
+                chat: actions
+                for chat, actions in self._chat_actions.items()
+                if max(actions.values()) > now
+            }
+        self._chat_actions.setdefault(chat, {})[key] = (
+            now + self.CHAT_ACTION_TTL
+        )
+        return await self._send(make_request, bot, method)
+
+    def _forget_chat_actions(self, chat):
+        self._chat_actions.pop(chat, None)
+
+    def _coalesce_edit(self, make_request, bot, method) -> bool:
+        key = (*self._chat_key(bot, method.chat_id), method.message_id)
+        edit_type = type(method)
+        pending = self._pending_edits.setdefault(key, {})
+        if edit_type in pending:
+            metrics.inc('telegram.edit_coalesced')
+            pending[edit_type] = method
+            return True
+        pending[edit_type] = method
+        task = asyncio.create_task(
+            self._flush_edit(make_request, bot, key, edit_type)
+        )
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return True
+
+    def _drop_pending_edit(self, bot, method):
+        key = (*self._chat_key(bot, method.chat_id), method.message_id)
+        pending = self._pending_edits.get(key, {})
+        pending.pop(type(method), None)
+        if not pending:
+            self._pending_edits.pop(key, None)
+
+    async def _flush_edit(self, make_request, bot, key, edit_type):
+        await self._wait_turn(key[:2])
+        pending = self._pending_edits.get(key, {})
+        method = pending.pop(edit_type, None)
+        if not pending:
+            self._pending_edits.pop(key, None)
+        if method is None:
+            # message got deleted while we were waiting
+            return
+        try:
+            await self._send(make_request, bot, method)
+        except TelegramAPIError as e:
+            logger.warning('Failed to edit message %s: %s', key, e)
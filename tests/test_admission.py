@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Lane, Overloaded
+
+
+@pytest.fixture()
+def controller():
+    return AdmissionController(
+        {'summary': Lane(concurrency=1, queue_size=1, max_wait=0.05, max_age=60)}
+    )
+
+
+def test_admission_sheds_when_queue_is_full(controller):
+    results = []
+
+    async def job(name):
+        try:
+            async with controller.admit('summary'):
+                await asyncio.sleep(0.02)
+                results.append(name)
+        except Overloaded:
+            results.append(f'{name} shed')
+
+    async def scenario():
+        await asyncio.gather(job('first'), job('second'), job('third'))
+
+    asyncio.run(scenario())
+
+    # first runs, second waits for its slot, third finds the queue full
+    assert results == ['third shed', 'first', 'second']
+
+
+def test_admission_sheds_after_deadline(controller):
+    async def scenario():
+        async with controller.admit('summary'):
+            with pytest.raises(Overloaded):
+                async with controller.admit('summary'):
+                    pass
+
+    asyncio.run(scenario())
+
+
+def test_admission_chat_is_not_blocked_by_busy_summary(controller):
+    async def scenario():
+        async with controller.admit('summary'):
+            async with controller.admit('chat'):
+                return True
+
+    assert asyncio.run(scenario())
+
+
+def test_admission_lanes_from_config_override_defaults():
+    controller = AdmissionController.from_config({'image': {'concurrency': 1}})
+
+    assert controller.lanes['image'].concurrency == 1
+    assert controller.lanes['image'].queue_size == 8
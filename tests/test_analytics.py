@@ -0,0 +1,20 @@
+from analytics import render_heatmap
+
+
+def test_render_heatmap_scales_to_busiest_hour():
+    grid = render_heatmap({'0:9': 10, '0:10': 1, '6:23': 5})
+    lines = grid.splitlines()
+
+    assert len(lines) == 8
+    monday, sunday = lines[1], lines[7]
+    assert monday.startswith('Пн ')
+    assert monday[3 + 9] == '█'
+    assert monday[3 + 10] == '░'
+    assert sunday[3 + 23] == '▒'
+    assert set(lines[3][3:]) == {' '}
+
+
+def test_render_heatmap_empty():
+    grid = render_heatmap({})
+
+    assert all(set(line[3:]) == {' '} for line in grid.splitlines()[1:])
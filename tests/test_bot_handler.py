@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import EditMessageText, SendMessage, SetMessageReaction
+
+import bot_handler
+from chat_completions import TextResponse
+
+
+CHAT_ID = -100500
+
+
+@pytest.fixture()
+def app(mocker):
+    app = mocker.Mock(spec=bot_handler.BotApp)
+    app.config = mocker.MagicMock()
+    app.config.positive_emojis = ['👍']
+    app.config.negative_emojis = ['👎']
+    app.config[CHAT_ID].save_messages = False
+    app.memory = None
+    app.replay = False
+    return app
+
+
+@pytest.fixture()
+def message(mocker):
+    msg = mocker.Mock(spec=types.Message)
+    # aiogram shortcuts return awaitable method objects, not coroutines
+    msg.reply = mocker.AsyncMock()
+    msg.answer = mocker.AsyncMock()
+    msg.react = mocker.AsyncMock()
+    msg.text = 'сравни a и b'
+    msg.reply_to_message = None
+    msg.from_user = mocker.Mock(spec=types.User)
+    msg.from_user.id = 12345678
+    msg.chat = mocker.Mock(spec=types.Chat)
+    msg.chat.id = CHAT_ID
+    msg.chat.do = mocker.AsyncMock()
+    return msg
+
+
+def test_llm_reply_is_escaped_for_html(app, message, mocker):
+    mocker.patch.object(
+        TextResponse,
+        'generate',
+        mocker.AsyncMock(return_value=TextResponse(success=True, text='a < b <3')),
+    )
+    bot = mocker.Mock(spec=bot_handler.Bot)
+    bot.id = 22222222
+
+    asyncio.run(bot_handler.handle_text_message(message, 'mention', bot, app))
+
+    message.reply.assert_awaited_once_with('a &lt; b &lt;3')
+    message.react.assert_awaited_once()
+
+
+def test_failed_final_edit_of_streamed_reply_falls_back_to_new_reply(
+    app, message, mocker
+):
+    async def generate(config, chat_id, messages, on_partial):
+        await on_partial('if a')
+        return TextResponse(success=True, text='if a < b then c.')
+
+    mocker.patch.object(TextResponse, 'generate', generate)
+    streamed = mocker.Mock(spec=types.Message)
+    streamed.edit_text = mocker.AsyncMock(
+        side_effect=TelegramBadRequest(
+            method=EditMessageText(text='if a < b then c.'),
+            message='message to edit not found',
+        )
+    )
+    message.reply.side_effect = [streamed, mocker.Mock(spec=types.Message)]
+    bot = mocker.Mock(spec=bot_handler.Bot)
+    bot.id = 22222222
+
+    asyncio.run(bot_handler.handle_text_message(message, 'mention', bot, app))
+
+    streamed.edit_text.assert_awaited_once_with('if a < b then c.', parse_mode=None)
+    assert message.reply.await_args_list[-1] == mocker.call('if a &lt; b then c.')
+
+
+def test_replay_requests_skip_reactions_and_missing_reply_targets():
+    sent = []
+
+    async def make_request(bot, method):
+        sent.append(method)
+        return True
+
+    replay = bot_handler.ReplayRequests()
+    reaction = SetMessageReaction(chat_id=CHAT_ID, message_id=7)
+    reply = SendMessage(chat_id=CHAT_ID, text='hi', reply_to_message_id=7)
+
+    async def scenario():
+        await replay(make_request, None, reaction)
+        await replay(make_request, None, reply)
+
+    asyncio.run(scenario())
+
+    assert sent == [reply]
+    assert reply.allow_sending_without_reply is True
+
+
+def test_replayed_messages_are_not_saved_or_counted(app, message, mocker):
+    mocker.patch.object(
+        TextResponse,
+        'generate',
+        mocker.AsyncMock(return_value=TextResponse(success=True, text='ok')),
+    )
+    analytics = mocker.patch('bot_handler.analytics')
+    app.config[CHAT_ID].save_messages = True
+    app.replay = True
+    app.ingest = mocker.Mock()
+    bot = mocker.Mock(spec=bot_handler.Bot)
+    bot.id = 22222222
+
+    asyncio.run(bot_handler.handle_text_message(message, 'mention', bot, app))
+
+    message.reply.assert_awaited_once_with('ok')
+    app.ingest.submit.assert_not_called()
+    analytics.record_llm_call.assert_not_called()
@@ -0,0 +1,61 @@
+import asyncio
+
+from chat_completions import TextResponse, anthropic_payload
+
+
+def test_anthropic_payload_caches_system_prompt_and_merges_turns():
+    system, turns = anthropic_payload(
+        [
+            ('system', 'you are a bot'),
+            ('system', 'recalled messages'),
+            ('assistant', 'earlier bot reply'),
+            ('user', 'first'),
+            ('user', 'second'),
+            ('assistant', ''),
+        ]
+    )
+
+    assert system == [
+        {
+            'type': 'text',
+            'text': 'you are a bot',
+            'cache_control': {'type': 'ephemeral'},
+        },
+        # changes from call to call, kept after the cached persona block
+        {'type': 'text', 'text': 'recalled messages'},
+    ]
+    assert turns == [
+        {'role': 'user', 'content': '…'},
+        {'role': 'assistant', 'content': 'earlier bot reply'},
+        {'role': 'user', 'content': 'first\n\nsecond'},
+    ]
+
+
+def test_streamed_reply_is_passed_on_while_generated(mocker):
+    mocker.patch('chat_completions.STREAM_UPDATE_INTERVAL', 0)
+
+    def chunk(content):
+        delta = mocker.Mock(content=content)
+        return mocker.Mock(choices=[mocker.Mock(delta=delta)], usage=None)
+
+    async def stream():
+        for content in ('При', 'вет', None, '!'):
+            yield chunk(content)
+
+    client = mocker.Mock()
+    client.chat.completions.create = mocker.AsyncMock(return_value=stream())
+    partials = []
+
+    async def on_partial(text):
+        partials.append(text)
+
+    reply = asyncio.run(
+        TextResponse._generate_openai(
+            client, 'local-model', [('user', 'hi')], on_partial=on_partial
+        )
+    )
+
+    assert reply.success
+    assert reply.text == 'Привет!'
+    assert partials == ['При', 'Привет', 'Привет', 'Привет!']
+    assert client.chat.completions.create.call_args.kwargs['stream'] is True
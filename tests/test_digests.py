@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from chat_completions import TextResponse
+from digests import HOUR, DigestFailed, DigestScheduler
+
+
+CHAT_ID = -100
+TAG = 'matvey-3000:history:dummy_bot:-100'
+# 10:30 .. 14:10 UTC of some day; there are no daily digests, so wherever
+# local midnight falls it does not change the plan
+START = 1700000000 // 86400 * 86400 + 10 * HOUR
+SINCE = START + HOUR // 2
+NOW = START + 4 * HOUR + 600
+
+
+@pytest.fixture()
+def config(mocker):
+    config = mocker.MagicMock()
+    config.history_key.return_value = TAG
+    config.model_for_chat_id.return_value = 'gpt-3.5-turbo'
+    return config
+
+
+@pytest.fixture()
+def message_store(mocker):
+    store = mocker.MagicMock()
+    hourly = {START + HOUR: b'eleven', START + 2 * HOUR: None, START + 3 * HOUR: b''}
+
+    def hmget(key, fields):
+        if key.endswith(':hour'):
+            return [hourly.get(field) for field in fields]
+        return [None] * len(fields)
+
+    def seq_range_between(tag, start, end):
+        return (start, end)
+
+    store.redis_conn.hmget.side_effect = hmget
+    store.redis_conn.get.return_value = None
+    store.seq_range_between.side_effect = seq_range_between
+    return store
+
+
+def test_plan_reuses_digests_and_fills_gaps_with_raw_messages(config, message_store):
+    scheduler = DigestScheduler(config, message_store, generate=None)
+
+    pieces = scheduler.plan(TAG, SINCE, NOW)
+
+    assert pieces == [
+        ('raw', SINCE, START + HOUR - 1),
+        ('hour', START + HOUR, 'eleven'),
+        ('raw', START + 2 * HOUR, START + 3 * HOUR - 1),
+        # 13:00 had no messages, its digest is empty
+        ('raw', START + 4 * HOUR, NOW),
+    ]
+
+
+def test_summarize_since_only_runs_final_reduce_over_digests(
+    mocker, config, message_store
+):
+    message_store.seq_range_between.side_effect = None
+    message_store.seq_range_between.return_value = None
+    mocker.patch('summary.token_counter', return_value=lambda text: len(text))
+    calls = []
+
+    async def generate(chat_id, messages, task):
+        calls.append((task, messages[1][1]))
+        return TextResponse(success=True, text='final')
+
+    scheduler = DigestScheduler(config, message_store, generate)
+
+    reply = asyncio.run(scheduler.summarize_since(CHAT_ID, SINCE, now=NOW))
+
+    assert reply.text == 'final'
+    assert calls == [('final_summary', 'eleven')]
+    message_store.redis_conn.set.assert_called_once()
+
+
+@pytest.fixture()
+def redis_store(mocker):
+    fakeredis = pytest.importorskip('fakeredis')
+    store = mocker.MagicMock()
+    store.redis_conn = fakeredis.FakeRedis()
+    # nobody wrote anything, so no LLM calls are made
+    store.seq_range_between.return_value = None
+    return store
+
+
+def test_update_chat_extends_lock_and_stops_when_it_is_taken_over(
+    config, redis_store
+):
+    scheduler = DigestScheduler(
+        config, redis_store, generate=None, offpeak_hours=tuple(range(24))
+    )
+    lock = scheduler.key(TAG, 'lock')
+    ttls = []
+
+    def seq_range_between(tag, start, end):
+        ttls.append(redis_store.redis_conn.ttl(lock))
+        if len(ttls) == 3:
+            redis_store.redis_conn.set(lock, 'other replica')
+        return None
+
+    redis_store.seq_range_between.side_effect = seq_range_between
+    # lock was taken a while ago
+    redis_store.redis_conn.set(lock, scheduler._token, ex=10)
+
+    with pytest.raises(DigestFailed):
+        asyncio.run(scheduler._update_hours(CHAT_ID, TAG, NOW))
+
+    assert ttls[0] <= 10
+    assert ttls[1:] == [scheduler.lock_ttl] * 2
+    assert redis_store.redis_conn.hlen(scheduler.key(TAG, 'hour')) == 3
+
+
+def test_update_chat_releases_only_its_own_lock(config, redis_store):
+    scheduler = DigestScheduler(config, redis_store, generate=None)
+    lock = scheduler.key(TAG, 'lock')
+
+    asyncio.run(scheduler.update_chat(CHAT_ID, now=NOW))
+    assert redis_store.redis_conn.get(lock) is None
+
+    redis_store.redis_conn.set(lock, 'other replica')
+    asyncio.run(scheduler.update_chat(CHAT_ID, now=NOW))
+    assert redis_store.redis_conn.get(lock) == b'other replica'
@@ -0,0 +1,12 @@
+from image_cache import ImageCache
+
+
+def test_image_cache_key_ignores_case_whitespace_and_trailing_punctuation():
+    cache = ImageCache(redis_conn=None, namespace='dummy_bot')
+
+    key = cache.key('dall-e', 'a cat  in a Hat!', '512x512')
+
+    assert key == cache.key('dall-e', '  A cat in a hat', '512x512')
+    assert key != cache.key('kandinski', 'a cat in a hat', '512x512')
+    assert key != cache.key('dall-e', 'a cat in a hat', '1024x1024')
+    assert key != cache.key('dall-e', 'a dog in a hat', '512x512')
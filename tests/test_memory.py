@@ -0,0 +1,54 @@
+import pytest
+
+from memory import HashingEmbedder, RetrievalMemory
+
+
+TAG = 'matvey-3000:history:dummy_bot:-100'
+
+
+@pytest.fixture()
+def memory(tmp_path):
+    return RetrievalMemory(tmp_path, HashingEmbedder(dim=256), top_k=2, min_score=0.2)
+
+
+def test_memory_finds_similar_messages_best_first(memory):
+    memory.index_many(
+        [
+            (TAG, 0, 'кто идёт в субботу на велосипедах кататься'),
+            (TAG, 1, 'купил новую видеокарту'),
+            (TAG, 2, 'велосипед сломался, кататься не получится'),
+            (TAG, 3, ''),
+        ]
+    )
+
+    hits = memory.search(TAG, 'где покататься на велосипеде')
+
+    assert sorted(seq for seq, _ in hits) == [0, 2]
+    assert hits[0][1] >= hits[1][1]
+    assert memory.search(TAG, 'погода') == []
+
+
+def test_memory_sees_appends_and_drop(memory, tmp_path):
+    assert memory.search(TAG, 'видеокарта') == []
+
+    memory.index_many([(TAG, 0, 'купил новую видеокарту')])
+    assert [seq for seq, _ in memory.search(TAG, 'видеокарту')] == [0]
+
+    # another instance reads the same files
+    reopened = RetrievalMemory(tmp_path, HashingEmbedder(dim=256), min_score=0.2)
+    memory.index_many([(TAG, 1, 'видеокарту вернул')])
+    assert sorted(seq for seq, _ in reopened.search(TAG, 'видеокарту')) == [0, 1]
+
+    memory.drop(TAG)
+    assert memory.search(TAG, 'видеокарту') == []
+
+
+def test_memory_drops_partial_row_left_by_interrupted_append(memory, tmp_path):
+    memory.index_many([(TAG, 0, 'кто идёт в субботу на велосипедах кататься')])
+    (vectors_path,) = tmp_path.glob('*.f32')
+    with vectors_path.open('ab') as fp:
+        fp.write(b'\0' * 12)
+
+    memory.index_many([(TAG, 1, 'купил видеокарту')])
+
+    assert [seq for seq, _ in memory.search(TAG, 'видеокарту')] == [1]
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from message_store import MessageStore, StoredChatMessage
+
+
+TAG = 'matvey-3000:history:dummy_bot:-100'
+SAVED = 'matvey-3000:stream:dummy_bot:saved'
+
+
+@pytest.fixture()
+def store(mocker):
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')  # SAVE_SCRIPT runs in fakeredis' lua
+    mocker.patch('redis.from_url', return_value=fakeredis.FakeRedis())
+    return MessageStore('redis://fake')
+
+
+def message(message_id, timestamp=1700000000, text=None):
+    return StoredChatMessage(
+        chat_name='chat',
+        from_username='user',
+        from_full_name='User',
+        timestamp=timestamp,
+        text=text or f'message {message_id}',
+        message_id=message_id,
+    )
+
+
+def test_stored_message_deserializes_records_without_message_id():
+    legacy = (
+        '{"chat_name": "chat", "from_username": "user", "from_full_name": "User", '
+        '"timestamp": "1700000000", "text": "hello"}'
+    )
+
+    message = StoredChatMessage.deserialize(legacy)
+
+    assert message.timestamp == 1700000000
+    assert message.message_id is None
+    assert message.reply_to is None
+
+
+def test_stored_message_roundtrip_keeps_message_ids():
+    message = StoredChatMessage(
+        chat_name='chat',
+        from_username='user',
+        from_full_name='User',
+        timestamp=1700000000,
+        text='привет',
+        message_id=42,
+        reply_to=41,
+    )
+
+    assert StoredChatMessage.deserialize(message.serialize()) == message
+
+
+def test_save_skips_redelivered_message(store):
+    assert store.save(TAG, message(10)) == 0
+    assert store.save(TAG, message(11)) == 1
+    assert store.save(TAG, message(10)) == -1
+
+    assert store.redis_conn.llen(TAG) == 2
+    assert store.seq_range_last(TAG, -1) == (0, 1)
+
+
+def test_save_many_announces_only_saved_messages(store):
+    store.save(TAG, message(1))
+
+    seqs = store.save_many(
+        [(TAG, message(1)), (TAG, message(2)), (TAG, message(2))],
+        saved_stream=SAVED,
+    )
+
+    assert seqs == [-1, 1, -1]
+    entries = store.redis_conn.xrange(SAVED)
+    assert [(fields[b'seq'], fields[b'tag']) for _, fields in entries] == [
+        (b'1', TAG.encode())
+    ]
+    assert StoredChatMessage.deserialize(entries[0][1][b'message']) == message(2)
+
+
+def test_seq_ranges_follow_timestamps(store):
+    for message_id in range(10):
+        store.save(TAG, message(message_id, timestamp=1000 + message_id * 100))
+
+    assert store.seq_range_between(TAG, 1250, 1600) == (3, 6)
+    assert store.seq_range_between(TAG, 5000, 6000) is None
+    assert store.seq_range_last(TAG, 3) == (7, 9)
+
+    async def collect():
+        return [m async for m in store.iter_seq_range(TAG, 3, 6, page_size=3)]
+
+    texts = [m.text for m in asyncio.run(collect())]
+    assert texts == ['message 3', 'message 4', 'message 5', 'message 6']
@@ -0,0 +1,61 @@
+import pytest
+
+from model_router import ModelRouter, RoutingRule
+
+
+@pytest.fixture()
+def rules():
+    return (
+        RoutingRule.from_dict(
+            {'provider': 'openai', 'tasks': ['summary_chunk'], 'models': ['fast']}
+        ),
+        RoutingRule.from_dict(
+            {'provider': 'openai', 'min_tokens': 5, 'models': ['long', 'fast']}
+        ),
+        RoutingRule.from_dict(
+            {
+                'provider': 'openai',
+                'models': ['strong', 'fast'],
+                'max_latency_ms': 1000,
+            }
+        ),
+    )
+
+
+@pytest.fixture()
+def router():
+    return ModelRouter(count_tokens=lambda text: len(text.split()))
+
+
+def test_router_picks_model_by_task_and_prompt_size(router, rules):
+    short = [('system', 'be nice'), ('user', 'hi')]
+    long = [('system', 'be nice'), ('user', 'tell me a long story')]
+
+    assert router.pick(rules, 'openai', 'summary_chunk', long, 'x') == 'fast'
+    assert router.pick(rules, 'openai', 'chat', long, 'x') == 'long'
+    assert router.pick(rules, 'openai', 'final_summary', short, 'x') == 'strong'
+    assert router.pick(rules, 'anthropic', 'chat', short, 'claude') == 'claude'
+
+
+def test_router_skips_slow_and_failing_models(router, rules):
+    messages = [('user', 'hi')]
+    router.record('openai', 'strong', latency_ms=5000, success=True)
+    assert router.pick(rules, 'openai', 'chat', messages, 'x') == 'fast'
+
+    router.record('openai', 'fast', latency_ms=100, success=False)
+    # both are unhealthy, the one that does not fail is less bad
+    assert router.pick(rules, 'openai', 'chat', messages, 'x') == 'strong'
+
+
+def test_router_probes_unhealthy_model_again(router, rules):
+    router.probe_after = 0
+    router.record('openai', 'strong', latency_ms=5000, success=False)
+
+    assert router.pick(rules, 'openai', 'chat', [('user', 'hi')], 'x') == 'strong'
+
+
+def test_routing_rule_rejects_unknown_task():
+    with pytest.raises(ValueError):
+        RoutingRule.from_dict(
+            {'provider': 'openai', 'tasks': ['poem'], 'models': ['a']}
+        )
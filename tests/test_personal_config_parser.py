@@ -2,7 +2,7 @@ import pytest
 import textwrap
 import warnings
 
-from config import Config
+from config import Config, ConfigWatcher
 
 
 @pytest.fixture()
@@ -124,3 +124,141 @@ def test_config_can_override_prompt_for_user1_no_effect_on_user2(
     # changing prompt for one user cannot override prompt for another one
     new_prompt2 = config[user2_id].prompt
     assert prompt_u2 == new_prompt2
+
+
+def test_config_override_is_written_through_and_applied_from_remote(
+    tmp_path_toml_config_v4,
+    user1_id,
+    user2_id,
+    new_nondefault_prompt,
+    mocker,
+):
+    with warnings.catch_warnings():
+        config = Config.read_toml(tmp_path_toml_config_v4)
+
+    overrides = mocker.Mock()
+    overrides.set.return_value = True
+    config.attach_overrides(overrides)
+    overrides.add_listener.assert_called_once_with(config.apply_overrides)
+
+    assert config.override_prompt_for_chat(user1_id, new_nondefault_prompt)
+    overrides.set.assert_called_once_with(user1_id, prompt=new_nondefault_prompt)
+
+    # another instance switched provider for user2
+    config.apply_overrides(user2_id, {'provider': config.PROVIDER_ANTHROPIC})
+    assert config.provider_for_chat_id(user2_id) == config.PROVIDER_ANTHROPIC
+    assert config.provider_for_chat_id(user1_id) != config.PROVIDER_ANTHROPIC
+
+    # redis is down, nothing changes locally either
+    overrides.set.return_value = False
+    assert not config.override_provider_for_chat_id(user1_id, config.PROVIDER_OPENAI)
+    assert not config.override_prompt_for_chat(user1_id, 'lost prompt')
+    assert config.provider_for_chat_id(user1_id) != config.PROVIDER_OPENAI
+    assert config[user1_id].prompt == new_nondefault_prompt
+
+
+def test_config_watcher_reload_adds_chat_and_keeps_overrides(
+    tmp_path_toml_config_v4,
+    user1_id,
+    new_nondefault_prompt,
+    mocker,
+):
+    with warnings.catch_warnings():
+        config = Config.read_toml(tmp_path_toml_config_v4)
+    overrides = mocker.Mock()
+    overrides.items.return_value = [(user1_id, {'prompt': new_nondefault_prompt})]
+    config.attach_overrides(overrides)
+    new_chat_id = -100500
+
+    assert new_chat_id not in config.allowed_chat_id
+
+    with tmp_path_toml_config_v4.open('a') as fp:
+        fp.write(
+            f'\n[[chats.allowed]]\nid = {new_chat_id}\nwho = "new group"\n'
+            'summary_enabled = true\n'
+        )
+    watcher = ConfigWatcher(config, tmp_path_toml_config_v4)
+
+    assert watcher.reload()
+    assert new_chat_id in config.allowed_chat_id
+    assert new_chat_id in config.summary_chat_id
+    assert len(config) == 3
+    assert config[user1_id].prompt == new_nondefault_prompt
+
+
+def test_config_watcher_keeps_old_config_on_invalid_file(
+    tmp_path_toml_config_v4,
+    user1_id,
+):
+    with warnings.catch_warnings():
+        config = Config.read_toml(tmp_path_toml_config_v4)
+
+    with tmp_path_toml_config_v4.open('a') as fp:
+        fp.write(f'\n[[chats.allowed]]\nid = {user1_id}\nwho = "duplicate"\n')
+    watcher = ConfigWatcher(config, tmp_path_toml_config_v4)
+
+    assert not watcher.reload()
+    assert len(config) == 2
+    assert config[user1_id].who == 'user1'
+
+
+def test_read_dir_needs_own_token_for_every_bot(tmp_path_toml_config_v4, bot_me):
+    directory = tmp_path_toml_config_v4.parent
+    toml = tmp_path_toml_config_v4.read_text()
+    other = directory / 'zz_other_bot.toml'
+    other.write_text(toml.replace(bot_me, '@other_bot'))
+
+    with pytest.raises(ValueError, match='same telegram_token_env'):
+        Config.read_dir(directory)
+
+    other.write_text(
+        'telegram_token_env = "OTHER_BOT_TOKEN"\n'
+        + toml.replace(bot_me, '@other_bot')
+    )
+    configs = Config.read_dir(directory)
+
+    assert [c.me_strip_lower for c in configs.values()] == ['dummy_bot', 'other_bot']
+    assert configs[str(other)].telegram_token_env == 'OTHER_BOT_TOKEN'
+
+
+def test_openai_compatible_providers(tmp_path_toml_config_v4, user1_id):
+    with tmp_path_toml_config_v4.open('a') as fp:
+        fp.write(
+            '\n[providers.local]\n'
+            'type = "openai-compatible"\n'
+            'base_url = "http://localhost:8000/v1"\n'
+            'model = "qwen2.5-7b-instruct"\n'
+            'stream = true\n'
+        )
+    config = Config.read_toml(tmp_path_toml_config_v4)
+
+    assert config.provider_names[-1] == 'local'
+    assert config.providers['local'].stream
+    assert config.override_provider_for_chat_id(user1_id, 'local')
+    assert config.model_for_chat_id(user1_id) == 'qwen2.5-7b-instruct'
+
+    with tmp_path_toml_config_v4.open('a') as fp:
+        fp.write('\n[providers.openai]\nbase_url = "http://x/v1"\nmodel = "m"\n')
+    with pytest.raises(ValueError, match='shadow built-in'):
+        Config.read_toml(tmp_path_toml_config_v4)
+
+
+@pytest.mark.parametrize(
+    'broken',
+    [
+        '\n[[chats.allowed]]\nid = 1\nwho = "x"\nprompt = 5\n',
+        '\n[chats]\nallowed = "x"\n',
+    ],
+)
+def test_config_watcher_survives_wrong_types(tmp_path_toml_config_v4, broken):
+    with warnings.catch_warnings():
+        config = Config.read_toml(tmp_path_toml_config_v4)
+    toml = tmp_path_toml_config_v4.read_text()
+    if 'allowed = ' in broken:
+        # replace the chats table instead of adding a second one
+        toml = toml[: toml.index('[[chats.allowed]]')]
+    tmp_path_toml_config_v4.write_text(toml + broken)
+    watcher = ConfigWatcher(config, tmp_path_toml_config_v4)
+
+    assert not watcher.reload()
+    assert len(config) == 2
@@ -0,0 +1,83 @@
+import pytest
+
+from aiogram import types
+from prefilter import PreFilterMiddleware
+
+
+@pytest.fixture()
+def bot_id():
+    return 22222222
+
+
+@pytest.fixture()
+def group_id():
+    return -1001000000777
+
+
+@pytest.fixture()
+def prefilter(group_id, mocker):
+    config = mocker.Mock()
+    config.allowed_chat_id = frozenset({group_id})
+    config.me_strip_lower = 'dummy_bot'
+    return PreFilterMiddleware(config, ingest=mocker.Mock(), random_reply_chance=0)
+
+
+@pytest.fixture()
+def make_message(group_id, mocker):
+    def _make(text, entities=None, reply_to_user_id=None, chat_id=group_id):
+        msg = mocker.Mock(spec=types.Message)
+        msg.text = text
+        msg.caption = None
+        msg.entities = entities
+        msg.caption_entities = None
+        msg.chat = mocker.Mock(spec=types.Chat)
+        msg.chat.id = chat_id
+        msg.chat.type = 'private' if chat_id > 0 else 'supergroup'
+        msg.reply_to_message = None
+        if reply_to_user_id is not None:
+            msg.reply_to_message = mocker.Mock(spec=types.Message)
+            msg.reply_to_message.from_user = mocker.Mock(spec=types.User)
+            msg.reply_to_message.from_user.id = reply_to_user_id
+        return msg
+
+    return _make
+
+
+def test_prefilter_drops_plain_group_chatter(prefilter, make_message, bot_id):
+    msg = make_message('just talking to my friends here')
+    assert prefilter.classify(msg, bot_id) == 'not_addressed'
+
+
+def test_prefilter_drops_replies_to_other_users(prefilter, make_message, bot_id):
+    msg = make_message('yeah totally agree', reply_to_user_id=12345678)
+    assert prefilter.classify(msg, bot_id) == 'reply_to_other'
+
+
+def test_prefilter_passes_replies_to_bot(prefilter, make_message, bot_id):
+    msg = make_message('and what do you think?', reply_to_user_id=bot_id)
+    assert prefilter.classify(msg, bot_id) == 'reply_to_bot'
+
+
+def test_prefilter_passes_mention_entity(prefilter, make_message, bot_id):
+    text = 'hey @Dummy_Bot what is up'
+    mention = types.MessageEntity(type='mention', offset=4, length=10)
+    msg = make_message(text, entities=[mention])
+    assert prefilter.classify(msg, bot_id) == 'mention'
+
+
+def test_prefilter_ignores_mention_of_other_bot(prefilter, make_message, bot_id):
+    text = 'hey @other_bot what is up'
+    mention = types.MessageEntity(type='mention', offset=4, length=10)
+    msg = make_message(text, entities=[mention])
+    assert prefilter.classify(msg, bot_id) == 'not_addressed'
+
+
+def test_prefilter_passes_commands_from_unknown_chats(prefilter, make_message, bot_id):
+    command = types.MessageEntity(type='bot_command', offset=0, length=6)
+    msg = make_message('/blerb', entities=[command], chat_id=-42)
+    assert prefilter.classify(msg, bot_id) == 'command'
+
+
+def test_prefilter_drops_single_words(prefilter, make_message, bot_id):
+    msg = make_message('lol', reply_to_user_id=bot_id)
+    assert prefilter.classify(msg, bot_id) == 'single_word'
@@ -0,0 +1,60 @@
+import pytest
+
+from search_index import SearchIndex, tokenize
+
+
+TAG = 'matvey-3000:history:dummy_bot:-100'
+
+
+def test_tokenize_folds_case_yo_and_russian_endings():
+    assert tokenize('Котами') == tokenize('кот')
+    assert tokenize('Ёлки') == tokenize('елки')
+
+
+def test_tokenize_handles_english_plurals():
+    assert tokenize('Cats') == tokenize('cat')
+
+
+def test_tokenize_drops_stopwords_and_single_letters():
+    assert tokenize('и я в a the x') == []
+
+
+def test_tokenize_keeps_order_of_terms():
+    terms = tokenize('Матвей любит пельмени')
+    assert len(terms) == 3
+    assert terms[0].startswith('матв')
+    assert terms[2].startswith('пельмен')
+
+
+@pytest.fixture()
+def index():
+    fakeredis = pytest.importorskip('fakeredis')
+    return SearchIndex(fakeredis.FakeRedis())
+
+
+def test_search_finds_all_terms_newest_first(index):
+    index.index_many(
+        [
+            (TAG, 0, 'Матвей любит пельмени'),
+            (TAG, 1, 'кот ест пельмени'),
+            (TAG, 2, 'котами пельменями не делятся'),
+            (TAG, 3, 'просто кот'),
+            ('matvey-3000:history:dummy_bot:-200', 4, 'кот и пельмени'),
+        ]
+    )
+
+    assert index.search(TAG, 'пельмени') == [2, 1, 0]
+    assert index.search(TAG, 'коты пельмени') == [2, 1]
+    assert index.search(TAG, 'коты пельмени', limit=1) == [2]
+    assert index.search(TAG, 'и в') == []
+    # the temporary intersection key is cleaned up
+    assert not list(index.redis_conn.scan_iter(match='*_query*'))
+
+
+def test_drop_removes_only_that_chat(index):
+    other = 'matvey-3000:history:dummy_bot:-200'
+    index.index_many([(TAG, 0, 'кот'), (other, 0, 'кот')])
+
+    assert index.drop(TAG) == 1
+    assert index.search(TAG, 'кот') == []
+    assert index.search(other, 'кот') == [0]
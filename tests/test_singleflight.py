@@ -0,0 +1,38 @@
+import asyncio
+
+from singleflight import SingleFlight
+
+
+def test_singleflight_runs_concurrent_identical_calls_once(mocker):
+    redis_conn = mocker.MagicMock()
+    redis_conn.get.return_value = None
+    redis_conn.set.return_value = True
+    singleflight = SingleFlight(redis_conn, namespace='dummy_bot')
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'summary'
+
+    async def scenario():
+        key = singleflight.make_key(-100, 'sum', '6H', window=60)
+        assert key == singleflight.make_key(-100, 'sum', ' 6h ', window=60)
+        return await asyncio.gather(
+            *[singleflight.do(key, compute, dumps=str, loads=str) for _ in range(5)]
+        )
+
+    assert asyncio.run(scenario()) == ['summary'] * 5
+    assert len(calls) == 1
+
+
+def test_singleflight_uses_result_of_other_process(mocker):
+    redis_conn = mocker.MagicMock()
+    redis_conn.get.return_value = b'from another replica'
+    singleflight = SingleFlight(redis_conn, namespace='dummy_bot')
+    compute = mocker.AsyncMock()
+
+    result = asyncio.run(singleflight.do('key', compute, dumps=str, loads=str))
+
+    assert result == 'from another replica'
+    compute.assert_not_called()
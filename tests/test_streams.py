@@ -0,0 +1,77 @@
+import pytest
+
+from message_store import StoredChatMessage
+from streams import StreamConsumer, StreamWorker
+
+
+TAG = 'matvey-3000:history:dummy_bot:-100'
+
+
+def _entry(entry_id, text):
+    message = StoredChatMessage('chat', 'user', 'User', 1700000000, text)
+    fields = {b'tag': TAG.encode(), b'seq': b'7', b'message': message.serialize()}
+    return entry_id, fields
+
+
+class Recorder(StreamConsumer):
+    group = 'recorder'
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.seen = []
+
+    def handle(self, entries):
+        if self.fail:
+            raise RuntimeError('boom')
+        self.seen.extend((e.tag, e.seq, e.message.text) for e in entries)
+
+
+@pytest.fixture()
+def redis_conn(mocker):
+    redis_conn = mocker.MagicMock()
+    redis_conn.xpending_range.return_value = []
+    redis_conn.xinfo_groups.return_value = []
+    redis_conn.xreadgroup.return_value = [
+        [b'stream', [_entry(b'1-0', 'hello'), _entry(b'2-0', 'world')]]
+    ]
+    return redis_conn
+
+
+def test_stream_worker_acks_handled_batch(redis_conn):
+    consumer = Recorder()
+    worker = StreamWorker(redis_conn, 'stream', consumer)
+
+    assert worker.step() == 2
+
+    assert consumer.seen == [(TAG, 7, 'hello'), (TAG, 7, 'world')]
+    redis_conn.xack.assert_called_once_with('stream', 'recorder', b'1-0', b'2-0')
+
+
+def test_stream_worker_leaves_failed_batch_pending(redis_conn):
+    worker = StreamWorker(redis_conn, 'stream', Recorder(fail=True))
+
+    assert worker.step() == 0
+
+    redis_conn.xack.assert_not_called()
+
+
+def test_stream_worker_retries_stale_entries_and_buries_poison(redis_conn):
+    redis_conn.xpending_range.return_value = [
+        {'message_id': b'1-0', 'times_delivered': 2},
+        {'message_id': b'2-0', 'times_delivered': 5},
+    ]
+    redis_conn.xclaim.side_effect = [
+        [_entry(b'2-0', 'poison')],  # claimed to move to the dead stream
+        [_entry(b'1-0', 'hello')],  # claimed for a retry
+    ]
+    consumer = Recorder()
+    worker = StreamWorker(redis_conn, 'stream', consumer, max_deliveries=5)
+
+    assert worker.step() == 1
+
+    assert consumer.seen == [(TAG, 7, 'hello')]
+    pipe = redis_conn.pipeline.return_value.__enter__.return_value
+    assert pipe.xadd.call_args.args[0] == 'stream:dead'
+    pipe.xack.assert_called_once_with('stream', 'recorder', b'2-0')
+    redis_conn.xack.assert_called_once_with('stream', 'recorder', b'1-0')
+    redis_conn.xreadgroup.assert_not_called()
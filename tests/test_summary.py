@@ -0,0 +1,116 @@
+import asyncio
+import datetime
+
+import pytest
+
+from chat_completions import TextResponse
+from summary import SummaryWindow, build_chunks, parse_window, summarize
+
+
+@pytest.fixture()
+def now():
+    return datetime.datetime(2024, 3, 10, 15, 30).timestamp()
+
+
+def test_parse_window_defaults_to_whole_history(now):
+    assert parse_window(None, now) == SummaryWindow(limit=-1)
+    assert parse_window('  ', now) == SummaryWindow(limit=-1)
+
+
+def test_parse_window_message_count(now):
+    assert parse_window('500', now) == SummaryWindow(limit=500)
+
+
+@pytest.mark.parametrize(
+    'args, seconds',
+    [('30m', 1800), ('6h', 6 * 3600), ('2d', 2 * 86400), ('1W', 7 * 86400)],
+)
+def test_parse_window_durations(now, args, seconds):
+    assert parse_window(args, now) == SummaryWindow(since=int(now - seconds))
+
+
+@pytest.mark.parametrize('args', ['2024-03-08', '08.03.2024', '08.03'])
+def test_parse_window_dates(now, args):
+    expected = datetime.datetime(2024, 3, 8).timestamp()
+    assert parse_window(args, now) == SummaryWindow(since=int(expected))
+
+
+@pytest.mark.parametrize(
+    'args, today, expected',
+    [
+        ('29.02', (2028, 3, 10), (2028, 2, 29)),
+        ('29.02', (2029, 1, 10), (2028, 2, 29)),
+        # later in the year than today is last year
+        ('20.12', (2024, 3, 10), (2023, 12, 20)),
+        ('10.03', (2024, 3, 10, 15, 30), (2024, 3, 10)),
+    ],
+)
+def test_parse_window_day_and_month_is_latest_past_date(args, today, expected):
+    now = datetime.datetime(*today).timestamp()
+    since = datetime.datetime(*expected).timestamp()
+    assert parse_window(args, now) == SummaryWindow(since=int(since))
+
+
+def test_parse_window_rejects_garbage(now):
+    with pytest.raises(ValueError):
+        parse_window('yesterday-ish', now)
+
+
+@pytest.mark.parametrize('args', ['0', '000'])
+def test_parse_window_rejects_empty_count(now, args):
+    with pytest.raises(ValueError):
+        parse_window(args, now)
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+def _count_words(text):
+    return len(text.split())
+
+
+async def _collect(agen):
+    return [item async for item in agen]
+
+
+def test_build_chunks_keeps_order_and_token_budget():
+    texts = ['one two three', 'four five', 'six', 'seven eight nine ten']
+
+    chunks = asyncio.run(
+        _collect(build_chunks(_aiter(texts), _count_words, max_tokens=8))
+    )
+
+    assert chunks == ['one two three\nfour five', 'six\nseven eight nine ten']
+
+
+def test_build_chunks_puts_oversized_text_into_its_own_chunk():
+    texts = ['a', 'b c d e f g h i j k', 'l']
+
+    chunks = asyncio.run(
+        _collect(build_chunks(_aiter(texts), _count_words, max_tokens=4))
+    )
+
+    assert chunks == ['a', 'b c d e f g h i j k', 'l']
+
+
+def test_summarize_maps_chunks_then_reduces_once():
+    calls = []
+
+    async def generate(messages, task):
+        calls.append((task, messages[1][1]))
+        return TextResponse(success=True, text=f'summary {len(calls)}')
+
+    texts = [f'message number {i}' for i in range(10)]
+    reply = asyncio.run(
+        summarize(
+            _aiter(texts), generate, _count_words, max_tokens=200, pause=0
+        )
+    )
+
+    assert reply.text == 'summary 2'
+    assert calls == [
+        ('summary_chunk', '\n'.join(texts)),
+        ('final_summary', 'summary 1'),
+    ]
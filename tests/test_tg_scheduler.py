@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendChatAction, SendMessage
+from tg_scheduler import RateLimiter, TelegramScheduler, awaited_edits
+
+
+class FakeSession:
+    def __init__(self, fail_with=None):
+        self.sent = []
+        self.fail_with = list(fail_with or [])
+
+    async def make_request(self, bot, method):
+        if self.fail_with:
+            raise self.fail_with.pop(0)
+        self.sent.append(method)
+        return True
+
+
+def test_rate_limiter_allows_burst_then_spaces_requests():
+    limiter = RateLimiter(rate=10, burst=3)
+
+    delays = [limiter.reserve() for _ in range(5)]
+
+    assert delays[:3] == [0, 0, 0]
+    assert 0.05 < delays[3] <= 0.1
+    assert 0.15 < delays[4] <= 0.2
+
+
+def test_scheduler_dedupes_chat_actions_until_message_is_sent():
+    session = FakeSession()
+    scheduler = TelegramScheduler()
+    typing = SendChatAction(chat_id=1, action='typing')
+
+    async def scenario():
+        await scheduler(session.make_request, None, typing)
+        await scheduler(session.make_request, None, typing)
+        await scheduler(session.make_request, None, SendMessage(chat_id=1, text='hi'))
+        await scheduler(session.make_request, None, typing)
+
+    asyncio.run(scenario())
+
+    assert [type(m).__name__ for m in session.sent] == [
+        'SendChatAction',
+        'SendMessage',
+        'SendChatAction',
+    ]
+
+
+def test_scheduler_sends_only_latest_of_rapid_edits():
+    session = FakeSession()
+    scheduler = TelegramScheduler()
+
+    async def scenario():
+        for i in range(5):
+            edit = EditMessageText(chat_id=-100, message_id=7, text=f'progress {i}')
+            await scheduler(session.make_request, None, edit)
+        await asyncio.gather(*scheduler._background)
+
+    asyncio.run(scenario())
+
+    assert [m.text for m in session.sent] == ['progress 4']
+
+
+def test_scheduler_retries_after_flood_control():
+    method = SendMessage(chat_id=1, text='hi')
+    flood = TelegramRetryAfter(method=method, message='flood', retry_after=0)
+    session = FakeSession(fail_with=[flood])
+    scheduler = TelegramScheduler()
+
+    asyncio.run(scheduler(session.make_request, None, method))
+
+    assert session.sent == [method]
+
+
+def test_scheduler_keeps_edits_of_different_bots_apart():
+    session = FakeSession()
+    scheduler = TelegramScheduler()
+
+    class FakeBot:
+        def __init__(self, id):
+            self.id = id
+
+    async def scenario():
+        for bot in (FakeBot(1), FakeBot(2)):
+            edit = EditMessageText(chat_id=-100, message_id=7, text=f'bot {bot.id}')
+            await scheduler(session.make_request, bot, edit)
+        await asyncio.gather(*scheduler._background)
+
+    asyncio.run(scenario())
+
+    assert sorted(m.text for m in session.sent) == ['bot 1', 'bot 2']
+
+
+def test_awaited_edit_replaces_pending_one_and_raises():
+    final = EditMessageText(chat_id=-100, message_id=7, text='if a < b then c.')
+    bad = TelegramBadRequest(method=final, message="can't parse entities")
+    session = FakeSession(fail_with=[bad])
+    scheduler = TelegramScheduler()
+
+    async def scenario():
+        partial = EditMessageText(chat_id=-100, message_id=7, text='if a')
+        await scheduler(session.make_request, None, partial)
+        with awaited_edits():
+            await scheduler(session.make_request, None, final)
+
+    with pytest.raises(TelegramBadRequest):
+        asyncio.run(scenario())
+
+    # the pending partial edit did not get sent after the final one
+    assert session.sent == []
+    assert scheduler._pending_edits == {}